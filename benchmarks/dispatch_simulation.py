@@ -0,0 +1,67 @@
+"""
+Simulation of lock attempts of runner hosts dispatching applications.
+
+Every application fires every minute. Every host tries to lock every
+application it evaluates at the minute boundary plus the application
+jitter, only one attempt per application wins. Prints lock attempts per
+second with and without jitter and sharding, and how evenly applications
+are spread across hosts.
+
+Usage: python benchmarks/dispatch_simulation.py [-a APPS] [-H HOSTS] [-j MAX_JITTER]
+"""
+from collections import Counter
+from optparse import OptionParser
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                'scheduler'))
+
+from sharding import HashRing, app_jitter
+
+
+def simulate(app_names, hosts, max_jitter, sharded):
+    ring = HashRing(hosts)
+    attempts = Counter()
+    for host in hosts:
+        shard = ring.shard(app_names, host) if sharded else app_names
+        for app_name in shard:
+            attempts[app_jitter(app_name, max_jitter)] += 1
+    return attempts
+
+
+def run(apps, hosts, max_jitter):
+    app_names = ['app%d' % i for i in xrange(apps)]
+    host_names = ['runner%d' % i for i in xrange(hosts)]
+
+    print 'applications: %d, hosts: %d, max jitter: %d secs' % (apps, hosts, max_jitter)
+    print '%-22s %10s %12s %12s' % ('', 'attempts', 'peak per sec', 'lost races')
+    for name, jitter, sharded in (('baseline', 0, False),
+                                  ('jitter', max_jitter, False),
+                                  ('sharding', 0, True),
+                                  ('jitter + sharding', max_jitter, True)):
+        attempts = simulate(app_names, host_names, jitter, sharded)
+        total = sum(attempts.values())
+        print '%-22s %10d %12d %12d' % (name, total, max(attempts.values()), total - apps)
+
+    shard_sizes = Counter(HashRing(host_names).owner(app_name) for app_name in app_names)
+    print 'applications per host:  min %d, max %d (even share %.1f)' % (
+        min(shard_sizes.values()), max(shard_sizes.values()), float(apps) / hosts)
+
+    # applications moved to other hosts when one host is added
+    before = HashRing(host_names)
+    after = HashRing(host_names + ['runner%d' % hosts])
+    moved = sum(1 for app_name in app_names if before.owner(app_name) != after.owner(app_name))
+    print 'moved by adding a host: %d (%.1f%%)' % (moved, 100.0 * moved / apps)
+
+
+if __name__ == '__main__':
+    opt = OptionParser(usage='usage: %prog [options]')
+    opt.add_option("-a", "--apps", dest="apps", type="int", default=1000,
+                   help="number of applications (default 1000)")
+    opt.add_option("-H", "--hosts", dest="hosts", type="int", default=8,
+                   help="number of runner hosts (default 8)")
+    opt.add_option("-j", "--jitter", dest="jitter", type="int", default=59,
+                   help="max jitter of application start in secs (default 59)")
+    (options, args) = opt.parse_args()
+    run(options.apps, options.hosts, options.jitter)
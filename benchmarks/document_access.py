@@ -0,0 +1,59 @@
+"""
+Microbenchmark of Document attribute reads (gcloud backend, no network used).
+
+Measures cost of a single read of:
+  * a field read for the first time (decoded from the entity)
+  * a field read again (cached value)
+  * a non-field attribute ("_entity")
+
+Usage: python benchmarks/document_access.py [-n NUMBER_OF_READS]
+"""
+from optparse import OptionParser
+import os
+import sys
+import timeit
+
+from gcloud import datastore
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+datastore.set_default_dataset_id(os.environ.get('GCLOUD_DATASET_ID', 'benchmarks'))
+
+import datastore_documents as documents
+
+
+class BenchmarkDocument(documents.Document):
+    title = documents.StringField()
+    counter = documents.IntField()
+    tags = documents.ListField()
+
+
+def _make_document():
+    entity = datastore.Entity(key=datastore.Key('BenchmarkDocument', 1))
+    entity.update({'title': u'benchmark', 'counter': 1, 'tags': [u'a', u'b']})
+    return documents._wrap_document(entity)
+
+
+def run(number):
+    docs = [_make_document() for _ in xrange(number)]
+    docs_iter = iter(docs)
+
+    results = {}
+    results['first field read'] = min(timeit.repeat(
+        lambda: next(docs_iter).title, number=number, repeat=1))
+
+    doc = _make_document()
+    results['cached field read'] = min(timeit.repeat(
+        lambda: doc.title, number=number, repeat=3))
+    results['non-field attribute read'] = min(timeit.repeat(
+        lambda: doc._entity, number=number, repeat=3))
+
+    for name, total in sorted(results.iteritems()):
+        print '%-26s %8.0f ns/read' % (name, total / number * 10**9)
+
+
+if __name__ == '__main__':
+    opt = OptionParser(usage='usage: %prog [options]')
+    opt.add_option("-n", "--number", dest="number", type="int", default=100000,
+                   help="number of reads per measurement (default 100000)")
+    (options, args) = opt.parse_args()
+    run(options.number)
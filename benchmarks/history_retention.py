@@ -0,0 +1,122 @@
+"""
+Benchmark of run history indexes and retention.
+
+Populates SQLite database with run history of applications started evenly
+over the last DAYS days and times typical history queries without indexes,
+with indexes and after old history is rolled up by compact_history().
+
+Usage: python benchmarks/history_retention.py [-n ROWS] [-a APPS] [-d DAYS]
+"""
+from datetime import datetime, timedelta
+from optparse import OptionParser
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                'scheduler'))
+
+import sqlalchemy
+from sqlalchemy import func
+from sqlalchemy.orm import sessionmaker
+
+from models import BaseModel, SchedulerModel, RunHistoryModel
+from retention import compact_history
+from stats import run_stats
+
+
+def populate(engine, rows, apps, days, now):
+    rnd = random.Random(42)
+    engine.execute(SchedulerModel.__table__.insert(),
+                   [{'name': 'app%d' % i, 'retry_cnt': 0} for i in xrange(apps)])
+    step = timedelta(days=days).total_seconds() / rows
+    start = now - timedelta(days=days)
+    chunk = []
+    for i in xrange(rows):
+        start_time = start + timedelta(seconds=i * step)
+        duration = rnd.expovariate(1 / 5.0)
+        chunk.append({'task_id': i % apps + 1,
+                      'start_time': start_time,
+                      'finish_time': start_time + timedelta(seconds=duration),
+                      'duration': duration,
+                      'exec_status': 'error' if rnd.random() < 0.02 else ''})
+        if len(chunk) == 50000:
+            engine.execute(RunHistoryModel.__table__.insert(), chunk)
+            chunk = []
+    if chunk:
+        engine.execute(RunHistoryModel.__table__.insert(), chunk)
+
+
+def timed(func, repeat=3):
+    best = None
+    for _ in xrange(repeat):
+        started = time.time()
+        func()
+        best = min(best or 1e9, time.time() - started)
+    return best
+
+
+def time_queries(session, apps, now):
+    task_id = apps // 2 + 1
+    queries = [
+        ('last 10 runs of one app', lambda: session.query(RunHistoryModel).
+            filter(RunHistoryModel.task_id == task_id).
+            order_by(RunHistoryModel.start_time.desc()).limit(10).all()),
+        ('failures of one app, 7 days', lambda: session.query(func.count(RunHistoryModel.id)).
+            filter(RunHistoryModel.task_id == task_id,
+                   RunHistoryModel.start_time >= now - timedelta(days=7),
+                   RunHistoryModel.exec_status != '').scalar()),
+        ('run_stats of all apps, 1 hour', lambda: run_stats(session, since=now - timedelta(hours=1), until=now)),
+    ]
+    for name, query in queries:
+        print '  %-32s %10.2f ms' % (name, timed(query) * 1000)
+
+
+def run(rows, apps, days):
+    directory = tempfile.mkdtemp()
+    try:
+        engine = sqlalchemy.create_engine('sqlite:///%s' % os.path.join(directory, 'history.db'))
+        BaseModel.metadata.create_all(bind=engine)
+        indexes = list(RunHistoryModel.__table__.indexes)
+        for index in indexes:
+            index.drop(bind=engine)
+        session = sessionmaker(bind=engine)()
+        now = datetime.now()
+
+        started = time.time()
+        populate(engine, rows, apps, days, now)
+        print 'history rows:   %d of %d apps over %d days (populated in %.1f s)' % (
+            rows, apps, days, time.time() - started)
+
+        print 'without indexes:'
+        time_queries(session, apps, now)
+
+        started = time.time()
+        for index in indexes:
+            index.create(bind=engine)
+        print 'with indexes (created in %.1f s):' % (time.time() - started)
+        time_queries(session, apps, now)
+
+        started = time.time()
+        raw_rows, hourly_rows = compact_history(session, now=now, keep_hourly_days=days // 2)
+        print 'after compaction of %d rows and %d hourly aggregates (%.1f s):' % (
+            raw_rows, hourly_rows, time.time() - started)
+        time_queries(session, apps, now)
+        session.close()
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    opt = OptionParser(usage='usage: %prog [options]')
+    opt.add_option("-n", "--rows", dest="rows", type="int", default=1000000,
+                   help="number of history rows (default 1000000)")
+    opt.add_option("-a", "--apps", dest="apps", type="int", default=100,
+                   help="number of applications (default 100)")
+    opt.add_option("-d", "--days", dest="days", type="int", default=60,
+                   help="days of history (default 60)")
+    (options, args) = opt.parse_args()
+    run(options.rows, options.apps, options.days)
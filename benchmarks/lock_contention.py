@@ -0,0 +1,156 @@
+"""
+Multi-process contention check of application locking and misfire backlog.
+
+Every round recreates SQLite database with applications which missed a few
+hourly fire times ('all' misfire policy) and starts processes which all
+try to run every application at the same instant. Every process sleeps for
+a random time between the due check and the lock, so other processes can
+run the application meanwhile. Every application must be run by exactly
+one process and its backlog recorded to history exactly once.
+
+Usage: python benchmarks/lock_contention.py [-p PROCESSES] [-a APPS] [-r ROUNDS]
+"""
+from datetime import datetime, timedelta
+import imp
+import logging
+import multiprocessing
+from optparse import OptionParser
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                'scheduler'))
+
+try:
+    import scheduler_config
+except ImportError:
+    # deployment configuration is not part of the repository, scheduler
+    # needs only the expire timeout from it
+    scheduler_config = imp.new_module('scheduler_config')
+    scheduler_config.APP_EXPIRE_TIMEOUT = 3600
+    sys.modules['scheduler_config'] = scheduler_config
+
+import sqlalchemy
+from sqlalchemy import func
+from sqlalchemy.orm import sessionmaker
+
+from models import BaseModel, SchedulerModel, RunHistoryModel
+from scheduler import AppScheduler
+
+MISSED_HOURS = 5
+
+
+class SimulatedScheduler(AppScheduler):
+    """Scheduler of application which only takes a little time to run."""
+
+    def run(self):
+        time.sleep(0.01)
+        return {'rows_processed': 1}
+
+
+def _sched_conf(apps):
+    # hourly fire time half an hour away from now, only missed runs are due
+    minute = (datetime.now().minute + 30) % 60
+    return dict(('app%d' % i, {'minutes': [minute], 'misfire': 'all'}) for i in xrange(apps))
+
+
+def _engine(path):
+    return sqlalchemy.create_engine('sqlite:///%s' % path, connect_args={'timeout': 60})
+
+
+def _contend(args):
+    path, sched_conf, start_at, seed = args
+    rnd = random.Random(seed)
+    session = sessionmaker(bind=_engine(path))()
+    app_names = sorted(sched_conf)
+    rnd.shuffle(app_names)
+    while time.time() < start_at:
+        time.sleep(0.001)
+    started = []
+    for app_name in app_names:
+        scheduler = SimulatedScheduler(app_name, sched_conf, session)
+        if not scheduler.should_start():
+            continue
+        # window in which another process may run the application
+        time.sleep(rnd.random() * 0.3)
+        if scheduler.start(force=True, last_started=scheduler.checked_start):
+            started.append(app_name)
+    session.close()
+    return started
+
+
+def run_round(path, processes, sched_conf, seed):
+    engine = _engine(path)
+    BaseModel.metadata.drop_all(engine)
+    BaseModel.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    now = datetime.now()
+    last_started = now - timedelta(hours=MISSED_HOURS, minutes=1)
+    for app_name in sched_conf:
+        session.add(SchedulerModel(name=app_name, retry_cnt=0, last_started=last_started))
+    session.commit()
+    expected_runs = SimulatedScheduler(sorted(sched_conf)[0], sched_conf, session).missed_runs(last_started, now)
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        start_at = time.time() + 1
+        results = pool.map(_contend, [(path, sched_conf, start_at, seed * 1000 + i)
+                                      for i in xrange(processes)])
+    finally:
+        pool.close()
+        pool.join()
+
+    errors = []
+    starts = {}
+    for started in results:
+        for app_name in started:
+            starts[app_name] = starts.get(app_name, 0) + 1
+    runs = dict(session.query(SchedulerModel.name, func.count(RunHistoryModel.id)).
+                join(RunHistoryModel, RunHistoryModel.task_id == SchedulerModel.id).
+                group_by(SchedulerModel.name))
+    for app_name in sorted(sched_conf):
+        if starts.get(app_name, 0) != 1:
+            errors.append('%s started by %d processes' % (app_name, starts.get(app_name, 0)))
+        if runs.get(app_name, 0) != expected_runs:
+            errors.append('%s has %d history rows, expected %d' % (app_name, runs.get(app_name, 0),
+                                                                    expected_runs))
+    session.close()
+    return errors
+
+
+def run(processes, apps, rounds):
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'contention.db')
+        sched_conf = _sched_conf(apps)
+        failed = 0
+        for i in xrange(rounds):
+            started = time.time()
+            errors = run_round(path, processes, sched_conf, i)
+            print 'round %d: %d processes, %d apps, %d errors (%.1f s)' % (
+                i + 1, processes, apps, len(errors), time.time() - started)
+            for error in errors[:10]:
+                print '  %s' % error
+            failed += bool(errors)
+        return not failed
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    # lost lock races are logged as warnings
+    logging.basicConfig(level=logging.ERROR)
+    opt = OptionParser(usage='usage: %prog [options]')
+    opt.add_option("-p", "--processes", dest="processes", type="int", default=8,
+                   help="number of contending processes (default 8)")
+    opt.add_option("-a", "--apps", dest="apps", type="int", default=20,
+                   help="number of applications (default 20)")
+    opt.add_option("-r", "--rounds", dest="rounds", type="int", default=3,
+                   help="number of rounds (default 3)")
+    (options, args) = opt.parse_args()
+    if not run(options.processes, options.apps, options.rounds):
+        sys.exit(1)
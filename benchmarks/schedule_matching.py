@@ -0,0 +1,69 @@
+"""
+Benchmark of compiled application schedules.
+
+Measures how many schedules are matched against the current minute per
+millisecond (the way AppScheduler checks all applications on every tick) and
+how long it takes to find next fire times.
+
+Usage: python benchmarks/schedule_matching.py [-n NUMBER_OF_SCHEDULES]
+"""
+from datetime import datetime
+from optparse import OptionParser
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                'scheduler'))
+
+from cron import CronSchedule
+from utils import get_datetime_struct
+
+
+def random_config(rnd):
+    def field(max_value, start=0):
+        if rnd.random() < 0.6:
+            return '*'
+        return rnd.sample(xrange(start, max_value), rnd.randint(1, 3))
+
+    return {'months': field(13, 1),
+            'days': field(32, 1),
+            'week_days': field(7),
+            'hours': field(24),
+            'minutes': field(60)}
+
+
+def run(number):
+    rnd = random.Random(42)
+    configs = [random_config(rnd) for _ in xrange(number)]
+
+    started = time.time()
+    schedules = [CronSchedule.from_config(conf) for conf in configs]
+    compile_time = time.time() - started
+
+    struct = get_datetime_struct(time.time())
+    match_time = None
+    for _ in xrange(5):
+        started = time.time()
+        matched = sum(1 for schedule in schedules if schedule.match_struct(struct))
+        match_time = min(match_time or 1e9, time.time() - started)
+
+    now = datetime.now()
+    started = time.time()
+    for schedule in schedules:
+        schedule.next_fire_time(now)
+    next_time = time.time() - started
+
+    print 'schedules:               %d (%d match current minute)' % (number, matched)
+    print 'compile:                 %8.3f ms' % (compile_time * 1000)
+    print 'match current minute:    %8.0f schedules/ms' % (number / (match_time * 1000))
+    print 'next_fire_time:          %8.0f schedules/ms' % (number / (next_time * 1000))
+
+
+if __name__ == '__main__':
+    opt = OptionParser(usage='usage: %prog [options]')
+    opt.add_option("-n", "--number", dest="number", type="int", default=10000,
+                   help="number of schedules (default 10000)")
+    (options, args) = opt.parse_args()
+    run(options.number)
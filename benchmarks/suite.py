@@ -0,0 +1,331 @@
+"""
+Benchmark suite of document and scheduler hot paths, runs without network:
+documents use in-process datastore emulator (datastore_local), scheduler
+uses in-memory SQLite database.
+
+Every benchmark is run "repeat" times and the best time is reported as
+operations per second. Results can be saved as JSON and compared with
+results of another commit, the suite fails if any benchmark is slower than
+in the baseline by more than the threshold.
+
+Usage: python benchmarks/suite.py [-s SIZES] [-a APPS] [-o RESULTS.json]
+                                  [-c BASELINE.json] [-t THRESHOLD] [-k NAME]
+"""
+from datetime import datetime, timedelta
+import gc
+import imp
+import json
+from optparse import OptionParser
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'scheduler'))
+
+os.environ['DATASTORE_BACKEND'] = 'local'
+
+import datastore_documents as documents
+from datastore_local import LocalDatastore
+
+try:
+    import scheduler_config
+except ImportError:
+    # deployment configuration is not part of the repository, scheduler
+    # needs only the expire timeout from it
+    scheduler_config = imp.new_module('scheduler_config')
+    scheduler_config.APP_EXPIRE_TIMEOUT = 3600
+    sys.modules['scheduler_config'] = scheduler_config
+
+import sqlalchemy
+from sqlalchemy.orm import sessionmaker
+
+from cron import CronSchedule
+from models import BaseModel, SchedulerModel
+from scheduler import AppScheduler, due_applications
+from utils import get_datetime_struct
+
+
+GROUPS = 100
+
+# minimal duration of one timed sample (secs)
+MIN_SAMPLE_TIME = 0.2
+
+
+class BenchmarkDocument(documents.Document):
+    title = documents.StringField()
+    counter = documents.IntField()
+    group = documents.IntField()
+    tags = documents.ListField()
+    meta = documents.DictField()
+    created = documents.DateTimeField()
+
+
+def _fresh_backend():
+    documents.set_backend(LocalDatastore())
+
+
+def _new_document(i):
+    return BenchmarkDocument(title=u'document %d' % i, counter=i, group=i % GROUPS,
+                             tags=[u'tag%d' % (i % 7), u'all'], meta={'i': i},
+                             created=datetime(2020, 1, 1) + timedelta(seconds=i))
+
+
+def _populate(size):
+    _fresh_backend()
+    BenchmarkDocument.bulk_save(_new_document(i) for i in xrange(size))
+
+
+def _raw_entities(size):
+    _populate(size)
+    return [doc._entity for doc in BenchmarkDocument.objects().all()]
+
+
+def bench_wrap(size):
+    entities = _raw_entities(size)
+    return lambda: [documents._wrap_document(entity) for entity in entities], size
+
+
+def bench_read_fields(size):
+    entities = _raw_entities(size)
+
+    def read():
+        for entity in entities:
+            doc = documents._wrap_document(entity)
+            doc.title, doc.counter, doc.group, doc.created
+    return read, size
+
+
+def bench_decode_list_dict(size):
+    entities = _raw_entities(size)
+
+    def read():
+        for entity in entities:
+            doc = documents._wrap_document(entity)
+            doc.tags, doc.meta
+    return read, size
+
+
+def bench_write_fields(size):
+    docs = [documents._wrap_document(entity) for entity in _raw_entities(size)]
+
+    def write():
+        for doc in docs:
+            doc.counter = doc.counter + 1
+            doc.title = u'updated'
+    return write, size
+
+
+def bench_resave_json(size):
+    _fresh_backend()
+    meta = dict(('key%d' % i, {'value': i, 'label': u'label %d' % i}) for i in xrange(50))
+    BenchmarkDocument.bulk_save(BenchmarkDocument(counter=i, meta=meta) for i in xrange(size))
+    docs = BenchmarkDocument.objects().all()
+
+    def resave():
+        for doc in docs:
+            doc.counter += 1
+        BenchmarkDocument.bulk_save(docs)
+    return resave, size
+
+
+def bench_resave_unchanged(size):
+    docs = [documents._wrap_document(entity) for entity in _raw_entities(size)]
+    return lambda: BenchmarkDocument.bulk_save(docs), size
+
+
+def bench_bulk_save(size):
+    _fresh_backend()
+    return lambda: BenchmarkDocument.bulk_save(_new_document(i) for i in xrange(size)), size
+
+
+def bench_fetch_all(size):
+    _populate(size)
+    return lambda: BenchmarkDocument.objects().all(), size
+
+
+def bench_filtered_fetch(size):
+    _populate(size)
+    matched = BenchmarkDocument.objects(group__lt=GROUPS // 10).count()
+    return lambda: BenchmarkDocument.objects(group__lt=GROUPS // 10).all(), matched
+
+
+def bench_in_fan_out(size):
+    _populate(size)
+    groups = range(0, GROUPS, GROUPS // 20)
+    matched = BenchmarkDocument.objects(group__in=groups).count()
+    return lambda: BenchmarkDocument.objects(group__in=groups).all(), matched
+
+
+def bench_values_list(size):
+    _populate(size)
+    return lambda: list(BenchmarkDocument.objects().values_list('counter', flat=True)), size
+
+
+def bench_schedule_match(size):
+    rnd = random.Random(42)
+
+    def field(max_value, start=0):
+        return '*' if rnd.random() < 0.6 else rnd.sample(xrange(start, max_value), rnd.randint(1, 3))
+
+    schedules = [CronSchedule(months=field(13, 1), days=field(32, 1), week_days=field(7),
+                              hours=field(24), minutes=field(60)) for _ in xrange(size)]
+    struct = get_datetime_struct(time.time())
+    return lambda: [schedule.match_struct(struct) for schedule in schedules], size
+
+
+def _schedulers(apps):
+    engine = sqlalchemy.create_engine('sqlite://')
+    BaseModel.metadata.create_all(bind=engine)
+    session = sessionmaker(bind=engine)()
+    sched_conf = {}
+    now = datetime.now()
+    for i in xrange(apps):
+        app_name = 'app%d' % i
+        sched_conf[app_name] = {'frequency': 60} if i % 2 else {'minutes': [i % 60]}
+        session.add(SchedulerModel(name=app_name, retry_cnt=0,
+                                   last_started=now - timedelta(seconds=i % 120)))
+    session.commit()
+    return session, [AppScheduler(app_name, sched_conf, session) for app_name in sorted(sched_conf)]
+
+
+def bench_should_start(apps):
+    session, schedulers = _schedulers(apps)
+    return lambda: [scheduler.should_start() for scheduler in schedulers], apps
+
+
+def bench_due_applications(apps):
+    session, schedulers = _schedulers(apps)
+    return lambda: due_applications(schedulers, session), apps
+
+
+# benchmarks of documents run for every size, scheduler ones for the number of apps
+DOCUMENT_BENCHMARKS = [
+    ('documents.wrap', bench_wrap),
+    ('documents.read_fields', bench_read_fields),
+    ('documents.decode_list_dict', bench_decode_list_dict),
+    ('documents.write_fields', bench_write_fields),
+    ('documents.bulk_save', bench_bulk_save),
+    ('documents.resave_json', bench_resave_json),
+    ('documents.resave_unchanged', bench_resave_unchanged),
+    ('documents.fetch_all', bench_fetch_all),
+    ('documents.filtered_fetch', bench_filtered_fetch),
+    ('documents.in_fan_out', bench_in_fan_out),
+    ('documents.values_list', bench_values_list),
+    ('scheduler.schedule_match', bench_schedule_match),
+]
+SCHEDULER_BENCHMARKS = [
+    ('scheduler.should_start', bench_should_start),
+    ('scheduler.due_applications', bench_due_applications),
+]
+
+
+def _timed(func, loops):
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        started = time.time()
+        for _ in xrange(loops):
+            func()
+        return time.time() - started
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+
+def measure(setup, size, repeat):
+    """
+    Times benchmark "repeat" times with garbage collector disabled (like
+    timeit), short benchmarks are looped to run at least MIN_SAMPLE_TIME.
+    """
+    func, ops = setup(size)
+    first = _timed(func, 1)
+    loops = max(1, int(MIN_SAMPLE_TIME / first) if first else 1000)
+    best = first if loops == 1 else None
+    for _ in xrange(repeat):
+        best = min(best or 1e9, _timed(func, loops) / loops)
+    return {'ops': ops, 'seconds': best, 'loops': loops,
+            'ops_per_sec': ops / best if best else None}
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                                       stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(sizes, apps, repeat, name_filter=None):
+    cases = [('%s[%d]' % (name, size), setup, size)
+             for size in sizes for name, setup in DOCUMENT_BENCHMARKS]
+    cases += [('%s[%d]' % (name, apps), setup, apps) for name, setup in SCHEDULER_BENCHMARKS]
+
+    results = {}
+    for name, setup, size in cases:
+        if name_filter and name_filter not in name:
+            continue
+        results[name] = measure(setup, size, repeat)
+        print '%-40s %12.0f ops/sec' % (name, results[name]['ops_per_sec'])
+    return {'meta': {'commit': _git_commit(),
+                     'python': platform.python_version(),
+                     'platform': platform.platform(),
+                     'created': datetime.now().isoformat(),
+                     'sizes': sizes,
+                     'apps': apps,
+                     'repeat': repeat},
+            'results': results}
+
+
+def compare(results, baseline, threshold):
+    """Prints changes against baseline results, returns names of regressed benchmarks."""
+    regressions = []
+    print '\n%-40s %12s %12s %8s' % ('compared with %s' % (baseline['meta'].get('commit') or 'baseline'),
+                                     'baseline', 'current', 'change')
+    for name in sorted(results['results']):
+        if name not in baseline['results']:
+            continue
+        before = baseline['results'][name]['ops_per_sec']
+        after = results['results'][name]['ops_per_sec']
+        change = after / before - 1
+        regressed = change < -threshold
+        if regressed:
+            regressions.append(name)
+        print '%-40s %12.0f %12.0f %+7.1f%%%s' % (name, before, after, change * 100,
+                                                  '  REGRESSION' if regressed else '')
+    return regressions
+
+
+if __name__ == '__main__':
+    opt = OptionParser(usage='usage: %prog [options]')
+    opt.add_option("-s", "--sizes", dest="sizes", default='1000,10000',
+                   help="comma-separated numbers of entities (default 1000,10000)")
+    opt.add_option("-a", "--apps", dest="apps", type="int", default=200,
+                   help="number of scheduled applications (default 200)")
+    opt.add_option("-r", "--repeat", dest="repeat", type="int", default=3,
+                   help="runs of every benchmark, the best is reported (default 3)")
+    opt.add_option("-k", "--filter", dest="name_filter", default=None,
+                   help="run only benchmarks with given substring in the name")
+    opt.add_option("-o", "--output", dest="output", default=None,
+                   help="write results as JSON to given file")
+    opt.add_option("-c", "--compare", dest="baseline", default=None,
+                   help="compare results with JSON results of a previous run")
+    opt.add_option("-t", "--threshold", dest="threshold", type="float", default=0.2,
+                   help="allowed slowdown against baseline (default 0.2 = 20%)")
+    (options, args) = opt.parse_args()
+
+    results = run([int(size) for size in options.sizes.split(',')], options.apps,
+                  options.repeat, options.name_filter)
+    if options.output:
+        with open(options.output, 'w') as stream:
+            json.dump(results, stream, indent=2, sort_keys=True)
+    if options.baseline:
+        with open(options.baseline) as stream:
+            regressions = compare(results, json.load(stream), options.threshold)
+        if regressions:
+            sys.exit('%d benchmarks regressed by more than %d%%: %s' % (
+                len(regressions), options.threshold * 100, ', '.join(regressions)))
@@ -0,0 +1,95 @@
+"""
+Stress check of wrapping entities from many threads at once.
+
+Every thread repeatedly wraps entities of two document kinds (in-process
+datastore emulator, no network) and checks that every document has the
+class, the entity and the field values of its own entity. Exits with
+non-zero status if any document sees state of another one.
+
+Usage: python benchmarks/thread_safety.py [-t THREADS] [-n ENTITIES] [-r ROUNDS]
+"""
+from optparse import OptionParser
+import os
+import sys
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ['DATASTORE_BACKEND'] = 'local'
+
+import datastore_documents as documents
+from datastore_local import LocalDatastore
+
+
+class Article(documents.Document):
+    title = documents.StringField()
+    counter = documents.IntField()
+    tags = documents.ListField()
+
+
+class Comment(documents.Document):
+    text = documents.StringField()
+    counter = documents.IntField()
+
+
+def _entities(size):
+    documents.set_backend(LocalDatastore())
+    documents.Document.bulk_save(Article(title=u'article %d' % i, counter=i, tags=[u'a%d' % i])
+                                 if i % 2 else Comment(text=u'comment %d' % i, counter=i)
+                                 for i in xrange(size))
+    return [doc._entity for doc in Article.objects().all() + Comment.objects().all()]
+
+
+def _check(doc, entity):
+    if doc._entity is not entity or type(doc).__name__ != entity.kind:
+        return 'wrong entity or class of %s' % entity.key.flat_path
+    i = entity['counter']
+    if doc.counter != i:
+        return 'counter %r of %s' % (doc.counter, entity.key.flat_path)
+    if isinstance(doc, Article):
+        if doc.title != u'article %d' % i or doc.tags != [u'a%d' % i]:
+            return 'fields (%r, %r) of article %d' % (doc.title, doc.tags, i)
+    elif doc.text != u'comment %d' % i:
+        return 'text %r of comment %d' % (doc.text, i)
+
+
+def run(threads, size, rounds):
+    entities = _entities(size)
+    errors = []
+    start = threading.Event()
+
+    def work(offset):
+        start.wait()
+        for _ in xrange(rounds):
+            # every thread walks the entities from another offset
+            for entity in entities[offset:] + entities[:offset]:
+                error = _check(documents._wrap_document(entity), entity)
+                if error:
+                    errors.append(error)
+                    return
+
+    workers = [threading.Thread(target=work, args=(i * len(entities) // threads,))
+               for i in xrange(threads)]
+    for worker in workers:
+        worker.start()
+    start.set()
+    for worker in workers:
+        worker.join()
+
+    print '%d threads wrapped %d entities %d times: %d errors' % (
+        threads, len(entities), rounds, len(errors))
+    for error in errors[:10]:
+        print '  %s' % error
+    return not errors
+
+
+if __name__ == '__main__':
+    opt = OptionParser(usage='usage: %prog [options]')
+    opt.add_option("-t", "--threads", dest="threads", type="int", default=16,
+                   help="number of threads (default 16)")
+    opt.add_option("-n", "--entities", dest="entities", type="int", default=1000,
+                   help="number of entities (default 1000)")
+    opt.add_option("-r", "--rounds", dest="rounds", type="int", default=20,
+                   help="wraps of every entity by every thread (default 20)")
+    (options, args) = opt.parse_args()
+    if not run(options.threads, options.entities, options.rounds):
+        sys.exit(1)
@@ -1,23 +1,45 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+import copy
 from datetime import datetime
 import logging
 import json
+import Queue
+import threading
+import time
+import uuid
 
 import os
 
 
 GAE_RUNNING = False
 
+# 'local' runs documents against in-process datastore emulator (datastore_local)
+DATASTORE_BACKEND = os.environ.get('DATASTORE_BACKEND', '')
 
-try:
-    from bson import ObjectId
-    from gcloud import datastore
-    from gcloud.datastore.key import Key
-except ImportError:
-    from google.appengine.ext import ndb
-    from google.appengine.api.datastore_types import ResolveAppId
-    from google.appengine.datastore import datastore_query
-    FIXED_APP_ID = ResolveAppId(None)
-    GAE_RUNNING = True
+if DATASTORE_BACKEND == 'local':
+    from multiprocessing.pool import ThreadPool
+
+    from datastore_local import LocalDatastore
+    datastore = LocalDatastore()
+    Key = datastore.Key
+    try:
+        from bson import ObjectId
+    except ImportError:
+        ObjectId = None
+else:
+    try:
+        from multiprocessing.pool import ThreadPool
+
+        from bson import ObjectId
+        from gcloud import datastore
+        from gcloud.datastore.key import Key
+    except ImportError:
+        from google.appengine.ext import ndb
+        from google.appengine.api.datastore_types import ResolveAppId
+        from google.appengine.datastore import datastore_query
+        FIXED_APP_ID = ResolveAppId(None)
+        GAE_RUNNING = True
 
 if GAE_RUNNING:
     KEY_CLASS = ndb.Key
@@ -25,6 +47,101 @@ else:
     KEY_CLASS = datastore.Key
 
 
+def set_backend(backend):
+    """
+    Switches documents to another implementation of gcloud.datastore API,
+    e.g. datastore_local.LocalDatastore() in tests and benchmarks.
+    """
+    global datastore, Key, KEY_CLASS
+    if GAE_RUNNING:
+        raise Exception('Datastore backend cannot be changed on App Engine')
+    datastore = backend
+    Key = KEY_CLASS = backend.Key
+
+
+def _make_key(kind, id_or_name):
+    if GAE_RUNNING:
+        return ndb.Key(kind, id_or_name, app=FIXED_APP_ID)
+    return Key(kind, id_or_name)
+
+
+_connection_state = threading.local()
+
+
+def _init_worker():
+    """Initializer of pool threads running datastore calls concurrently, see _connection()."""
+    _connection_state.worker = True
+
+
+def _connection():
+    """
+    Returns gcloud connection of the current pool thread (None elsewhere, the
+    default connection is used). Default connection wraps one httplib2.Http
+    which is not thread-safe, so every worker thread gets its own connection
+    with the same credentials. None with in-process emulator (thread-safe).
+    """
+    if GAE_RUNNING or not getattr(_connection_state, 'worker', False):
+        return None
+    connection = getattr(_connection_state, 'connection', None)
+    if connection is None:
+        get_default_connection = getattr(datastore, 'get_default_connection', None)
+        default = get_default_connection() if get_default_connection else None
+        if default is None:
+            return None
+        connection = _connection_state.connection = type(default)(
+            credentials=default.credentials, api_base_url=default.api_base_url)
+    return connection
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def _worker_pool(name, size):
+    """Returns shared pool of "size" threads with their own connections, see _connection()."""
+    with _pools_lock:
+        pool = _pools.get(name)
+        if pool is None:
+            pool = _pools[name] = ThreadPool(size, initializer=_init_worker)
+        return pool
+
+
+def _new_id():
+    if ObjectId is not None:
+        return str(ObjectId())
+    return uuid.uuid4().hex[:24]
+
+
+DEFAULT_PAGE_SIZE = 200
+KEYS_PAGE_SIZE = 1000
+
+# datastore limit of mutations in one commit
+MAX_BATCH_MUTATIONS = 500
+
+# maximum number of queries run in parallel for "__in"/"__ne" list filters
+MAX_QUERY_CONCURRENCY = 10
+
+# worker threads running blocking datastore calls of the async API
+MAX_ASYNC_CONCURRENCY = 10
+
+# JSON codec of DictField/ListField values, see set_json_codec()
+json_dumps, json_loads = json.dumps, json.loads
+
+
+EMPTY_JSON = '{}'
+
+
+def set_json_codec(dumps, loads):
+    """
+    Replaces functions encoding and decoding JSON values of documents, e.g.
+    by faster ones of orjson or ujson. Values must survive round trip
+    through the codec unchanged (ujson needs "precise_float=True"),
+    otherwise every read value is saved as changed.
+    """
+    global json_dumps, json_loads
+    json_dumps, json_loads = dumps, loads
+
+
 GLOBAL_DEV_LIMIT = None
 if os.environ.get('SERVER_SOFTWARE', '').startswith('Development'):
     GLOBAL_DEV_LIMIT = 5
@@ -128,9 +245,9 @@ class ReferenceField(BaseField):
     @classmethod
     def cast(self, value, follow_references=True):
         if isinstance(value, (list, tuple)) and len(value) == 2:
-            return KEY_CLASS(value[0], value[1], app=FIXED_APP_ID)
+            return _make_key(value[0], value[1])
         elif isinstance(value, (int, str, unicode)):
-            return KEY_CLASS(self.reference_key, int(value), app=FIXED_APP_ID)
+            return _make_key(self.reference_key, int(value))
         elif not value:
             return
         else:
@@ -142,7 +259,7 @@ class ReferenceField(BaseField):
     @classmethod
     def uncast(self, value, follow_references=True):
         if value and follow_references:
-            values = datastore.get([value])
+            values = _get_multi([value])
             if len(values) > 0:
                 return _wrap_document(values[0])
         return value
@@ -166,14 +283,11 @@ class ListField(BaseField):
         if not value:
             return []
         elif isinstance(value, (str, unicode)):
-            value = json.loads(value)
-        output_list = []
-        for item in value:
-            if hasattr(self, 'kind'):
-                output_list.append(self.kind().uncast(item, follow_references))
-            else:
-                output_list.append(item)
-        return output_list
+            value = json_loads(value)
+        if not hasattr(self, 'kind'):
+            return list(value)
+        kind_field = self.kind()
+        return [kind_field.uncast(item, follow_references) for item in value]
 
 
 class DateTimeField(BaseField):
@@ -194,25 +308,489 @@ class DictField(BaseField):
         if not value:
             return {}
         if isinstance(value, (str, unicode)):
-            value = json.loads(value)
+            value = json_loads(value)
         return value
 
     def uncast(self, value, follow_references=True):
         if not value:
             return {}
         elif isinstance(value, (str, unicode)):
-            value = json.loads(value)
+            value = json_loads(value)
         return value
 
     @classmethod
     def pre_save(self, value):
-        return json.dumps(value)
+        return json_dumps(value)
 
 
 def _wrap_document(entity, follow_references=True):
     return Document(entity=entity, follow_references=follow_references)
 
 
+def _key_path(key):
+    """Returns hashable (kind, id, ...) path of datastore key."""
+    if GAE_RUNNING:
+        return key.pairs()
+    return key.flat_path
+
+
+class EntityCache(object):
+    """
+    Identity map of fetched entities keyed by (kind, id) key path.
+    Keeps at most "max_size" recently used entities, each one for at most
+    "ttl" seconds (if given).
+    """
+
+    def __init__(self, max_size=1000, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entities = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        path = _key_path(key)
+        with self._lock:
+            item = self._entities.pop(path, None)
+            if item is not None and (item[1] is None or item[1] > time.time()):
+                self._entities[path] = item
+                self.hits += 1
+                return item[0]
+            self.misses += 1
+
+    def put(self, entity):
+        if entity is None or entity.key is None:
+            return
+        path = _key_path(entity.key)
+        expires_at = time.time() + self.ttl if self.ttl else None
+        with self._lock:
+            self._entities.pop(path, None)
+            self._entities[path] = (entity, expires_at)
+            while len(self._entities) > self.max_size:
+                self._entities.popitem(last=False)
+
+    def invalidate(self, key):
+        if key is None:
+            return
+        with self._lock:
+            self._entities.pop(_key_path(key), None)
+
+    def clear(self):
+        with self._lock:
+            self._entities.clear()
+
+    def stats(self):
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self._entities)}
+
+
+_entity_cache_state = threading.local()
+
+
+def get_entity_cache():
+    """Returns entity cache active in the current thread (or None)."""
+    return getattr(_entity_cache_state, 'cache', None)
+
+
+@contextmanager
+def entity_cache(max_size=1000, ttl=None):
+    """
+    Enables identity map cache for lookups by id and references resolving
+    within the block:
+
+        with entity_cache(max_size=5000) as cache:
+            ...
+            logging.info(cache.stats())
+    """
+    previous_cache = get_entity_cache()
+    cache = EntityCache(max_size=max_size, ttl=ttl)
+    _entity_cache_state.cache = cache
+    try:
+        yield cache
+    finally:
+        _entity_cache_state.cache = previous_cache
+
+
+def _invalidate_cached(keys):
+    cache = get_entity_cache()
+    if cache:
+        for key in keys:
+            cache.invalidate(key)
+
+
+def _put_multi(entities):
+    if GAE_RUNNING:
+        ndb.put_multi(entities)
+    else:
+        datastore.put(entities, connection=_connection())
+
+
+def _delete_multi(keys):
+    if GAE_RUNNING:
+        ndb.delete_multi(keys)
+    else:
+        datastore.delete(keys, connection=_connection())
+
+
+class BulkWriter(object):
+    """
+    Collects entities to put and keys to delete and commits them in batches
+    of at most "batch_size" mutations.
+    With "max_inflight" > 0 batches are committed by that many worker threads
+    while new mutations are being collected.
+    Latency of every committed batch (in seconds) is kept in "latencies",
+    number of saved documents without changes (not put) in "skipped".
+    """
+
+    def __init__(self, batch_size=MAX_BATCH_MUTATIONS, max_inflight=0):
+        self.batch_size = min(batch_size, MAX_BATCH_MUTATIONS)
+        self.max_inflight = max_inflight
+        self.latencies = []
+        self.skipped = 0
+        self._puts = []
+        self._deletes = []
+        self._lock = threading.Lock()
+        self._error = None
+        self._workers = []
+        self._queue = None
+        if max_inflight:
+            self._queue = Queue.Queue(maxsize=max_inflight)
+            for _ in xrange(max_inflight):
+                worker = threading.Thread(target=self.__work)
+                worker.daemon = True
+                worker.start()
+                self._workers.append(worker)
+
+    def put(self, entity):
+        self.__add('_puts', entity)
+
+    def delete(self, key):
+        self.__add('_deletes', key)
+
+    def __add(self, mutations, item):
+        with self._lock:
+            getattr(self, mutations).append(item)
+            if len(self._puts) + len(self._deletes) < self.batch_size:
+                return
+            puts, deletes = self.__take_pending()
+        self.__submit(puts, deletes)
+
+    def __take_pending(self):
+        puts, deletes = self._puts, self._deletes
+        self._puts, self._deletes = [], []
+        return puts, deletes
+
+    def __submit(self, puts, deletes):
+        if self._error:
+            raise self._error
+        if not puts and not deletes:
+            return
+        if self._queue:
+            self._queue.put((puts, deletes))
+        else:
+            self.__commit(puts, deletes)
+
+    def __commit(self, puts, deletes):
+        started = time.time()
+        if GAE_RUNNING:
+            if puts:
+                ndb.put_multi(puts)
+            if deletes:
+                ndb.delete_multi(deletes)
+        else:
+            batch = datastore.Batch(connection=_connection())
+            for entity in puts:
+                batch.put(entity)
+            for key in deletes:
+                batch.delete(key)
+            batch.commit()
+        latency = time.time() - started
+        self.latencies.append(latency)
+        logging.debug('Committed batch of %d puts and %d deletes in %.3f secs' %
+                      (len(puts), len(deletes), latency))
+
+    def __work(self):
+        _init_worker()
+        while True:
+            mutations = self._queue.get()
+            try:
+                if mutations is None:
+                    return
+                if not self._error:
+                    self.__commit(*mutations)
+            except Exception as e:
+                logging.exception('Error committing batch: %s' % e)
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def flush(self):
+        """Commits pending mutations and waits for all in-flight batches."""
+        with self._lock:
+            puts, deletes = self.__take_pending()
+        self.__submit(puts, deletes)
+        if self._queue:
+            self._queue.join()
+        if self._error:
+            raise self._error
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            for _ in self._workers:
+                self._queue.put(None)
+            self._workers = []
+
+    def stats(self):
+        latencies = self.latencies
+        return {'batches': len(latencies),
+                'skipped': self.skipped,
+                'total_time': sum(latencies),
+                'max_latency': max(latencies) if latencies else 0,
+                'avg_latency': sum(latencies) / len(latencies) if latencies else 0}
+
+
+_bulk_state = threading.local()
+
+
+def get_bulk_writer():
+    """Returns bulk writer active in the current thread (or None)."""
+    return getattr(_bulk_state, 'writer', None)
+
+
+@contextmanager
+def bulk_writer(batch_size=MAX_BATCH_MUTATIONS, max_inflight=0):
+    """
+    Batches all Document.save()/delete() calls within the block and commits
+    the rest of them on exit:
+
+        with bulk_writer(batch_size=500, max_inflight=2) as writer:
+            for row in rows:
+                Model(**row).save()
+        logging.info(writer.stats())
+    """
+    previous_writer = get_bulk_writer()
+    writer = BulkWriter(batch_size=batch_size, max_inflight=max_inflight)
+    _bulk_state.writer = writer
+    try:
+        yield writer
+    finally:
+        _bulk_state.writer = previous_writer
+        writer.close()
+
+
+@contextmanager
+def _writer_scope(batch_size=MAX_BATCH_MUTATIONS, max_inflight=0):
+    """Reuses bulk writer active in the current thread or opens a new one."""
+    writer = get_bulk_writer()
+    if writer:
+        yield writer
+    else:
+        with bulk_writer(batch_size, max_inflight) as writer:
+            yield writer
+
+
+def _get_multi(keys):
+    cache = get_entity_cache()
+    if not cache:
+        if GAE_RUNNING:
+            return ndb.get_multi(keys)
+        return datastore.get(keys, connection=_connection())
+
+    results = [cache.get(key) for key in keys]
+    missed_keys = [key for key, entity in zip(keys, results) if entity is None]
+    if missed_keys:
+        if GAE_RUNNING:
+            fetched = ndb.get_multi(missed_keys)
+        else:
+            fetched = datastore.get(missed_keys, connection=_connection())
+        fetched = dict((_key_path(entity.key), entity) for entity in fetched if entity is not None)
+        for i, key in enumerate(keys):
+            if results[i] is None:
+                results[i] = fetched.get(_key_path(key))
+                cache.put(results[i])
+    if not GAE_RUNNING:
+        # gcloud returns only found entities
+        results = [entity for entity in results if entity is not None]
+    return results
+
+
+_async_pool = None
+_async_pool_lock = threading.Lock()
+
+
+def get_async_pool():
+    """
+    Returns thread pool shared by all async calls (*_async(), aiter(),
+    gather_get()), at most MAX_ASYNC_CONCURRENCY datastore calls run at
+    a time, the rest wait in its queue. Its threads use their own
+    connections, see _connection().
+    """
+    global _async_pool
+    if GAE_RUNNING:
+        raise Exception('Async documents API is not supported on App Engine, use ndb *_async calls')
+    with _async_pool_lock:
+        if _async_pool is None:
+            _async_pool = ThreadPool(MAX_ASYNC_CONCURRENCY, initializer=_init_worker)
+        return _async_pool
+
+
+def set_async_concurrency(workers):
+    """Replaces the async pool by one with given number of worker threads."""
+    global _async_pool, MAX_ASYNC_CONCURRENCY
+    with _async_pool_lock:
+        previous_pool, _async_pool = _async_pool, None
+        MAX_ASYNC_CONCURRENCY = workers
+    if previous_pool is not None:
+        previous_pool.close()
+
+
+def _call_with_cache(cache, func, args, kwargs):
+    previous_cache = get_entity_cache()
+    _entity_cache_state.cache = cache
+    try:
+        return func(*args, **kwargs)
+    finally:
+        _entity_cache_state.cache = previous_cache
+
+
+def run_async(func, *args, **kwargs):
+    """
+    Runs blocking call in the async pool and returns its AsyncResult, the
+    call uses entity cache of the calling thread:
+
+        pending = [Model.objects(group=group).all_async() for group in groups]
+        results = [result.get() for result in pending]
+    """
+    return get_async_pool().apply_async(_call_with_cache, (get_entity_cache(), func, args, kwargs))
+
+
+class GatheredResult(object):
+    """
+    Result of several async calls with the same interface as AsyncResult,
+    get() returns their results combined by "combine" function.
+    """
+
+    def __init__(self, results, combine):
+        self._results = results
+        self._combine = combine
+
+    def ready(self):
+        return all(result.ready() for result in self._results)
+
+    def wait(self, timeout=None):
+        deadline = time.time() + timeout if timeout is not None else None
+        for result in self._results:
+            result.wait(max(0, deadline - time.time()) if deadline else None)
+
+    def get(self, timeout=None):
+        deadline = time.time() + timeout if timeout is not None else None
+        return self._combine([result.get(max(0, deadline - time.time()) if deadline else None)
+                              for result in self._results])
+
+
+def gather_get(keys, follow_references=True, batch_size=KEYS_PAGE_SIZE):
+    """
+    Fetches documents of given keys by batches of "batch_size" keys run
+    concurrently in the async pool. Returns GatheredResult, its get()
+    returns found documents in the order of keys.
+    """
+    keys = list(keys)
+
+    def combine(batches):
+        entities = dict((_key_path(entity.key), entity) for entities in batches
+                        for entity in entities if entity is not None)
+        return [_wrap_document(entities[_key_path(key)], follow_references) for key in keys
+                if _key_path(key) in entities]
+
+    return GatheredResult([run_async(_get_multi, keys[i:i + batch_size])
+                           for i in xrange(0, len(keys), batch_size)], combine)
+
+
+def _merge_by_key(result_sets, intersect=False):
+    """
+    Merges lists of entities by their keys (union or intersection), keeping
+    the order of first occurrence and dropping duplicates.
+    """
+    merged = OrderedDict()
+    for i, entities in enumerate(result_sets):
+        current = OrderedDict((_key_path(entity.key), entity) for entity in entities
+                              if entity is not None)
+        if intersect and i > 0:
+            merged = OrderedDict((k, v) for k, v in merged.iteritems() if k in current)
+        else:
+            for k, v in current.iteritems():
+                merged.setdefault(k, v)
+    return merged
+
+
+def _raw_value(entity, field_name):
+    if GAE_RUNNING:
+        return getattr(entity, field_name, None)
+    return entity.get(field_name)
+
+
+def _same_value(stored, value):
+    """
+    Compares stored entity value with a new one. gcloud loads datetimes
+    tz-aware (UTC) while documents use naive ones (see _decode_field()).
+    """
+    if isinstance(stored, datetime) and isinstance(value, datetime):
+        return stored.replace(tzinfo=None) == value.replace(tzinfo=None)
+    try:
+        return stored == value
+    except TypeError:
+        return False
+
+
+def _projection_query(query, projection):
+    """Returns copy of gcloud query fetching given properties only."""
+    return datastore.Query(query.kind,
+                           dataset_id=query.dataset_id,
+                           namespace=query.namespace,
+                           ancestor=query.ancestor,
+                           filters=query.filters,
+                           projection=list(projection),
+                           order=query.order,
+                           group_by=query.group_by)
+
+
+def _keys_only_query(query):
+    """Returns copy of gcloud query fetching keys of entities only."""
+    return _projection_query(query, ['__key__'])
+
+
+def _entity_id(entity):
+    if GAE_RUNNING:
+        return entity.key.id()
+    return entity.key.id or entity.key.name
+
+
+def _value_getter(field_name, field):
+    """
+    Returns function reading value of the field from raw entity without
+    wrapping it into Document. References are not followed and only fields
+    stored encoded (ListField, DictField) are uncast.
+    """
+    if field_name == 'id':
+        return _entity_id
+    decode = not GAE_RUNNING and field_name != 'account' and isinstance(field, (ListField, DictField))
+
+    def get_value(entity):
+        value = _raw_value(entity, field_name)
+        if value == 'None':
+            value = None
+        elif isinstance(value, datetime) and not GAE_RUNNING:
+            value = value.replace(tzinfo=None)
+        if decode:
+            value = field.uncast(value, follow_references=False)
+        return value
+    return get_value
+
+
 class QueryError(Exception):
     pass
 
@@ -220,100 +798,273 @@ class QuerySetManager(object):
     def __init__(self, entity, document):
         self._document = document
         self._entity = entity
-        self.__post_processors = []
         self.__reset_query()
 
-    def __fetch_all(self, limit=None, offset=None, local_results=None):
-        results = []
-        results_batch = []
-
+    def __fetch_pages(self, limit=None, page_size=None, local_results=None, offset=None,
+                      keys_only=False):
+        """
+        Yields query results page by page. Every next page is resumed from the
+        cursor returned with the previous one instead of re-scanning by offset.
+        With "keys_only" pages contain keys instead of entities.
+        """
         limit = limit or GLOBAL_DEV_LIMIT
-        default_limit = limit or 200
-        initial_limit = limit or 0
-        default_offset = offset or 0
+        page_size = page_size or (KEYS_PAGE_SIZE if keys_only else DEFAULT_PAGE_SIZE)
+        offset = offset or 0
 
-        if self.__results:
-            results = self.__results
+        if local_results is None and self.__results:
+            results = self.__results[offset:offset + limit] if limit else self.__results[offset:]
+            if keys_only:
+                results = [entity.key for entity in results if entity is not None]
+            yield results
 
         extra_options = {}
-        if GAE_RUNNING and self.__fields_projection:
+        if GAE_RUNNING and keys_only:
+            extra_options['keys_only'] = True
+        elif GAE_RUNNING and self.__fields_projection:
             extra_options['projection'] = self.__fields_projection
 
         results_query = local_results or self.__results_query
-        if results_query:
-            while True:
-                logging.debug('Start Query %s (fields: %s)' % (str(results_query.kind), str(self.__fields_projection)))
-
-                results_batch = results_query.fetch(limit=default_limit,
-                                                    offset=default_offset,
-                                                    **extra_options)
-                logging.debug('End Query %s' % str(results_query.filters))
-                results_batch = list(results_batch)
-                if results_batch:
-                    results.extend(results_batch)
-                if not results_batch or len(results_batch) < default_limit or len(results_batch) <= initial_limit:
-                    break
-                default_offset += default_limit
+        if not results_query:
+            return
+        if keys_only and not GAE_RUNNING:
+            results_query = _keys_only_query(results_query)
+
+        cursor = None
+        fetched = 0
+        while True:
+            batch_size = min(page_size, limit - fetched) if limit else page_size
+            logging.debug('Start Query %s (fields: %s)' % (str(results_query.kind), str(self.__fields_projection)))
+            if cursor is None and offset:
+                # offset is skipped on the server for the first page only
+                extra_options['offset'] = offset
+            else:
+                extra_options.pop('offset', None)
+            if GAE_RUNNING:
+                results_batch, cursor, more_results = results_query.fetch_page(batch_size,
+                                                                               start_cursor=cursor,
+                                                                               **extra_options)
+            else:
+                query_iter = results_query.fetch(limit=batch_size, start_cursor=cursor,
+                                                 connection=_connection(),
+                                                 **extra_options)
+                results_batch, more_results, cursor = query_iter.next_page()
+            logging.debug('End Query %s' % str(results_query.filters))
+
+            results_batch = list(results_batch)
+            if keys_only and not GAE_RUNNING:
+                results_batch = [entity.key for entity in results_batch]
+            fetched += len(results_batch)
+            if results_batch:
+                yield results_batch
+            # gcloud reports more_results=False for every page of a limited
+            # query (MORE_RESULTS_AFTER_LIMIT), a full page is followed by next one
+            if GAE_RUNNING and not more_results:
+                break
+            if not results_batch or not cursor or \
+                    len(results_batch) < batch_size or (limit and fetched >= limit):
+                break
+
+    def __fetch_all(self, limit=None, offset=None, local_results=None):
+        results = []
+        if not self.__post_processors:
+            for results_batch in self.__fetch_pages(limit, local_results=local_results,
+                                                    offset=offset):
+                results.extend(results_batch)
+            return results
+
+        # in-memory post processing needs all results before limiting
+        for results_batch in self.__fetch_pages(local_results=local_results):
+            results.extend(results_batch)
         for _post_processor in self.__post_processors:
             results = _post_processor(results)
-        return results
+        offset = offset or 0
+        limit = limit or GLOBAL_DEV_LIMIT
+        return results[offset:offset + limit] if limit else results[offset:]
 
     def __add_post_processor(self, func):
         self.__post_processors.append(func)
 
-    def all(self, limit=None, follow_references=True):
-        entities = self.__fetch_all(limit)
+    def __prefetch_references(self, documents, follow_references=True):
+        """
+        Resolves all references of the "select_related" fields across given
+        documents with a single batch get and caches them in the documents.
+        """
+        if not self.__select_related or not follow_references or not documents:
+            return documents
+
+        keys = {}
+        for doc in documents:
+            for field_name in self.__select_related:
+                value = _raw_value(doc._entity, field_name)
+                if not isinstance(value, list):
+                    value = [value]
+                for key in value:
+                    if isinstance(key, KEY_CLASS):
+                        keys[_key_path(key)] = key
+        if not keys:
+            return documents
+
+        resolved = {}
+        for entity in _get_multi(keys.values()):
+            if entity is not None:
+                resolved[_key_path(entity.key)] = _wrap_document(entity)
+
+        for doc in documents:
+            for field_name in self.__select_related:
+                value = _raw_value(doc._entity, field_name)
+                if isinstance(value, KEY_CLASS):
+                    if _key_path(value) in resolved:
+                        doc._cached_fields[field_name] = resolved[_key_path(value)]
+                elif isinstance(value, list) and value and isinstance(value[0], KEY_CLASS):
+                    doc._cached_fields[field_name] = [resolved[_key_path(key)] for key in value
+                                                      if _key_path(key) in resolved]
+        return documents
+
+    def all(self, limit=None, follow_references=True, offset=None):
+        entities = self.__fetch_all(limit, offset)
 
         results = []
         for entity in entities:
             results.append(_wrap_document(entity, follow_references))
             #yield self.__wrap_document(entity)
-        return results
+        return self.__prefetch_references(results, follow_references)
+
+    def all_async(self, limit=None, follow_references=True, offset=None):
+        """Runs all() in the async pool, returns AsyncResult of the documents."""
+        return run_async(self.__snapshot().all, limit, follow_references, offset)
+
+    def __snapshot(self):
+        """Copy of the current query which is not reset by next calls of the manager."""
+        query = copy.copy(self)
+        query.__post_processors = list(self.__post_processors)
+        return query
+
+    def __pages(self, page_size=None):
+        if self.__post_processors:
+            # post processors (e.g. in-memory ordering) need the whole result set
+            yield self.__fetch_all()
+        else:
+            for results_batch in self.__fetch_pages(page_size=page_size):
+                yield results_batch
+
+    def iterator(self, page_size=None, follow_references=True):
+        """
+        Lazily yields wrapped documents, holding only one page of entities
+        in memory at a time.
+        """
+        for results_batch in self.__pages(page_size):
+            documents = [_wrap_document(entity, follow_references) for entity in results_batch]
+            for doc in self.__prefetch_references(documents, follow_references):
+                yield doc
+
+    def aiter(self, page_size=None, follow_references=True):
+        """
+        Like iterator(), but the next page is fetched in the async pool while
+        documents of the current one are being processed.
+        """
+        query = self.__snapshot()
+        pages = query.__pages(page_size)
+        pending = run_async(next, pages, None)
+        while True:
+            results_batch = pending.get()
+            if results_batch is None:
+                return
+            pending = run_async(next, pages, None)
+            documents = [_wrap_document(entity, follow_references) for entity in results_batch]
+            for doc in query.__prefetch_references(documents, follow_references):
+                yield doc
+
+    def __iter__(self):
+        return self.iterator()
+
+    def __getitem__(self, item):
+        """
+        Supports "qs[start:stop]" slices (limit and offset are passed to the
+        query) and "qs[index]".
+        """
+        if not isinstance(item, slice):
+            results = self[item:item + 1]
+            if not results:
+                raise IndexError('Query result index out of range')
+            return results[0]
+
+        if item.step not in (None, 1):
+            raise QueryError('Query slicing with step is not supported')
+        start = item.start or 0
+        if start < 0 or (item.stop is not None and item.stop < 0):
+            raise QueryError('Query slicing with negative indexes is not supported')
+        if item.stop is None:
+            return self.all(offset=start)
+        if item.stop <= start:
+            return []
+        return self.all(limit=item.stop - start, offset=start)
 
     def no_dereference(self, limit=None):
         return self.all(limit, follow_references=False)
 
+    def bulk_delete(self, batch_size=MAX_BATCH_MUTATIONS):
+        """Deletes all matched entities in batches, page by page."""
+        with _writer_scope(batch_size) as writer:
+            for keys in self.__fetch_pages(page_size=batch_size, keys_only=True):
+                for key in keys:
+                    writer.delete(key)
+                _invalidate_cached(keys)
+
     def delete(self):
-        enitity_keys = []
-        for entity in self.__fetch_all():
-            enitity_keys.append(entity.key)
-        if enitity_keys:
-            ndb.delete_multi(enitity_keys)
+        self.bulk_delete()
 
     def distinct(self, field_name):
-        entities = self.__fetch_all()
+        return list(set(self.values_list(field_name, flat=True, projection=False)))
 
-        unique_records = set()
-        for entity in entities:
-            doc = _wrap_document(entity)
-            value = getattr(doc, field_name, None)
-            if value not in unique_records:
-                unique_records.add(value)
-        return list(unique_records)
+    def count(self):
+        """Counts matched entities fetching their keys only."""
+        return sum(len(keys) for keys in self.__fetch_pages(keys_only=True))
+
+    def exists(self):
+        for keys in self.__fetch_pages(limit=1, keys_only=True):
+            if keys:
+                return True
+        return False
 
     def first(self):
         results = list(self.__fetch_all(limit=1))
 
         if len(results) > 0:
-            return _wrap_document(results[0])
+            return self.__prefetch_references([_wrap_document(results[0])])[0]
         else:
             return None
 
-    def order_by(self, doc_property):
-        if doc_property[0] == '-':
-            field = doc_property[1:]
-            reverse = True
-        else:
-            field = doc_property
-            reverse = False
-        if GAE_RUNNING:
-            order = datastore_query.PropertyOrder.DESCENDING if reverse else datastore_query.PropertyOrder.ASCENDING
-            order = datastore_query.PropertyOrder(field, order)
-            self.__results_query = self.__results_query.order(order)
+    def order_by(self, *doc_properties):
+        orders = []
+        for doc_property in doc_properties:
+            if doc_property[0] == '-':
+                orders.append((doc_property[1:], True))
+            else:
+                orders.append((doc_property, False))
+
+        if not self.__results_query:
+            # results are already fetched (e.g. by "__in" filters), sort them in memory
+            def sort_results(results):
+                for field, reverse in reversed(orders):
+                    results = sorted(results, key=lambda x: _raw_value(x, field), reverse=reverse)
+                return results
+            self.__add_post_processor(sort_results)
+        elif GAE_RUNNING:
+            for field, reverse in orders:
+                order = datastore_query.PropertyOrder.DESCENDING if reverse else datastore_query.PropertyOrder.ASCENDING
+                order = datastore_query.PropertyOrder(field, order)
+                self.__results_query = self.__results_query.order(order)
         else:
+            self.__results_query.order = list(self.__results_query.order) + list(doc_properties)
 
-            self.__add_post_processor(lambda results: sorted(results, key=lambda x: getattr(x, field), reverse=reverse))
+        return self
 
+    def select_related(self, *fields):
+        """
+        Dereferences given ReferenceField/ListField fields for every fetched
+        page with one batch request instead of one request per document.
+        """
+        self.__select_related = fields
         return self
 
     def only(self, *keys):
@@ -321,10 +1072,64 @@ class QuerySetManager(object):
             self.__fields_projection = keys
         return self
 
-    def values_list(self, key):
-        if self.__results:
-            for entity in self.__results.fetch():
-                yield getattr(_wrap_document(entity), key)
+    def __projectable(self, fields):
+        """Checks if all given fields can be fetched by projection query."""
+        exclude_from_indexes = getattr(self._document, '_exclude_from_indexes', ())
+        for field_name in fields:
+            field = self._document._fields.get(field_name)
+            if field is None or field_name in exclude_from_indexes:
+                return False
+            if GAE_RUNNING:
+                if field._repeated or not field._indexed:
+                    return False
+            elif isinstance(field, (ListField, DictField, TextField, BlobField)):
+                return False
+        return True
+
+    def __iter_values(self, fields, projection=None):
+        unknown_fields = [f for f in fields if f not in self._document._fields]
+        if unknown_fields:
+            raise QueryError('Unknown fields of %s: %s' % (self._document._key_name,
+                                                           ', '.join(unknown_fields)))
+        getters = [_value_getter(f, self._document._fields[f]) for f in fields]
+
+        projected_fields = [f for f in fields if f != 'id']
+        if projection is None:
+            # projection of several properties needs a composite index
+            projection = len(projected_fields) == 1
+        query = self
+        if projection and projected_fields and self.__projectable(projected_fields):
+            # projected copy, the query itself keeps fetching whole entities
+            query = self.__snapshot()
+            query.__fields_projection = tuple(projected_fields)
+            if query.__results_query is not None and not GAE_RUNNING:
+                query.__results_query = _projection_query(query.__results_query, projected_fields)
+
+        for results_batch in query.__pages():
+            for entity in results_batch:
+                yield tuple(get_value(entity) for get_value in getters)
+
+    def values(self, *fields, **kwargs):
+        """
+        Yields dicts of given fields values for every matched entity, reading
+        them straight from query results. A single indexed field is fetched by
+        projection query (skipping entities without the property, pass
+        "projection=False" to disable it), several fields only with
+        "projection=True" as they need a composite index.
+        """
+        for values in self.__iter_values(fields, kwargs.get('projection')):
+            yield dict(zip(fields, values))
+
+    def values_list(self, *fields, **kwargs):
+        """
+        Yields tuples of given fields values like values(). With "flat=True"
+        (default for single field) yields single values instead of tuples.
+        """
+        flat = kwargs.get('flat', len(fields) == 1)
+        if flat and len(fields) != 1:
+            raise QueryError('values_list() with flat=True accepts only one field')
+        for values in self.__iter_values(fields, kwargs.get('projection')):
+            yield values[0] if flat else values
 
     def __parse_operator(self, key):
         key_parts = key.split('__', 1)
@@ -355,13 +1160,78 @@ class QuerySetManager(object):
             raise NotImplementedError('Query received unknown operator: %s' % key)
         return (key_name, operator, alt_value)
 
+    def __build_keys(self, key_ids):
+        return [_make_key(self._document._key_name, try_int(id)) for id in key_ids]
+
     def __get_keys(self, key_ids):
-        keys = [KEY_CLASS(self._document._key_name, try_int(id), app=FIXED_APP_ID) for id in key_ids]
+        return _get_multi(self.__build_keys(key_ids))
+
+    def __fetch_query(self, query):
+        results = []
+        for results_batch in self.__fetch_pages(local_results=query):
+            results.extend(results_batch)
+        return results
+
+    def __fan_out(self, queries):
+        """
+        Fetches results of all given queries concurrently, running at most
+        MAX_QUERY_CONCURRENCY queries at a time.
+        """
+        if len(queries) <= 1:
+            return [self.__fetch_query(query) for query in queries]
+
         if GAE_RUNNING:
-            entities = ndb.get_multi(keys)
-        else:
-            entities = datastore.get(keys)
-        return entities
+            extra_options = {}
+            if self.__fields_projection:
+                extra_options['projection'] = self.__fields_projection
+            results = []
+            for i in xrange(0, len(queries), MAX_QUERY_CONCURRENCY):
+                futures = [query.fetch_async(limit=GLOBAL_DEV_LIMIT, **extra_options)
+                           for query in queries[i:i + MAX_QUERY_CONCURRENCY]]
+                results.extend(list(future.get_result()) for future in futures)
+            return results
+
+        return _worker_pool('query', MAX_QUERY_CONCURRENCY).map(self.__fetch_query, queries)
+
+    def __filter_by_lists(self, in_conditions, nin_conditions, query_filters, query_kwargs):
+        """
+        Runs one query per value of every "__in"/"__ne" list condition in
+        parallel. Results of "__in" values are united, results of "__ne" values
+        are intersected, then all conditions are intersected by entity key.
+        """
+        queries = []
+        groups = []
+        excluded_keys = set()
+        for conditions, operator in ((in_conditions, '='), (nin_conditions, '!=')):
+            for condition in conditions:
+                if condition['key'] == 'id':
+                    if operator == '=':
+                        groups.append((operator, [self.__get_keys(condition['values'])]))
+                    else:
+                        excluded_keys.update(_key_path(key) for key in
+                                             self.__build_keys(condition['values']))
+                    continue
+
+                first_query = len(queries)
+                for item in condition['values']:
+                    local_filters = query_filters[:]
+                    local_filters.append((condition['key'], operator, item))
+                    queries.append(self.__generate_query(local_filters, query_kwargs))
+                groups.append((operator, (first_query, len(queries))))
+
+        if not groups:
+            queries.append(self.__generate_query(query_filters, query_kwargs))
+            groups.append(('=', (0, 1)))
+
+        queries_results = self.__fan_out(queries)
+        groups_results = []
+        for operator, group in groups:
+            if isinstance(group, tuple):
+                group = queries_results[group[0]:group[1]]
+            groups_results.append(_merge_by_key(group, intersect=operator == '!=').values())
+
+        results = _merge_by_key(groups_results, intersect=True)
+        return [entity for key, entity in results.iteritems() if key not in excluded_keys]
 
     def __generate_query(self, query_filters, query_kwargs):
         if GAE_RUNNING:
@@ -405,11 +1275,10 @@ class QuerySetManager(object):
                         output_list.append(item._entity.key)
                     elif key_name != 'id':
                         field = getattr(self._document, key_name)
-                        if isinstance(field, ndb.KeyProperty):
-                            if GAE_RUNNING:
-                                output_list.append(KEY_CLASS(field.kind, try_int(item), app=FIXED_APP_ID))
-                            else:
-                                output_list.append(field.cast(item))
+                        if GAE_RUNNING and isinstance(field, ndb.KeyProperty):
+                            output_list.append(_make_key(field.kind, try_int(item)))
+                        elif not GAE_RUNNING and isinstance(field, ReferenceField):
+                            output_list.append(field.cast(item))
                         else:
                             output_list.append(item)
                     else:
@@ -430,46 +1299,9 @@ class QuerySetManager(object):
             else:
                 query_filters.append((key_name, operator, v))
 
-        if main_in_conditions:
-            results = []
-            for main_in_condition in main_in_conditions:
-                if main_in_condition['key'] == 'id':
-                    results = [self.__get_keys(main_in_condition['values'])]
-                else:
-                    results_local = []
-                    for item in main_in_condition['values']:
-                        local_filters = query_filters[:]
-                        local_filters.append((main_in_condition['key'], '=', item))
-                        query = self.__generate_query(local_filters, query_kwargs)
-
-                        results_local += self.__fetch_all(local_results=query)
-                    results.append(results_local)
-            results_end = results[0][:]
-            if len(results) > 1:
-                results_end = [val for val in results[0] if val in results[1]]
-            if len(results) > 2:
-                results_end = [val for val in results_end if val in results[2]]
-            self.__results = results_end
-        elif main_nin_conditions:
-            results = []
-            for main_nin_condition in main_nin_conditions:
-                if main_nin_condition['key'] == 'id':
-                    results = [self.__get_keys(main_nin_condition['values'])]
-                else:
-                    results_local = []
-                    for item in main_nin_condition['values']:
-                        local_filters = query_filters[:]
-                        local_filters.append((main_nin_condition['key'], '!=', item))
-                        query = self.__generate_query(local_filters, query_kwargs)
-
-                        results_local += self.__fetch_all(local_results=query)
-                    results.append(results_local)
-            results_end = results[0][:]
-            if len(results) > 1:
-                results_end = [val for val in results[0] if val in results[1]]
-            if len(results) > 2:
-                results_end = [val for val in results_end if val in results[2]]
-            self.__results = results_end
+        if main_in_conditions or main_nin_conditions:
+            self.__results = self.__filter_by_lists(main_in_conditions, main_nin_conditions,
+                                                    query_filters, query_kwargs)
         else:
             self.__results_query = self.__generate_query(query_filters, query_kwargs)
         return self
@@ -477,13 +1309,41 @@ class QuerySetManager(object):
     def __reset_query(self):
         self.__results = []
         self.__results_query = None
+        self.__post_processors = []
         self.__fields_projection = None
+        self.__select_related = ()
 
 
 
 ALL_DOCUMENTS = {}
-ACTIVE_TRANSACTION = None
-TRANSACTION_ENTITIES = []
+
+class FieldDescriptor(object):
+    """
+    Data descriptor created by DocumentMetaClass for every document field.
+    The value is decoded from the entity on first read and cached in the
+    document, reading the field from the class returns the field itself.
+    """
+    __slots__ = ('name', 'field')
+
+    def __init__(self, name, field):
+        self.name = name
+        self.field = field
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self.field
+        cached_fields = instance._cached_fields
+        value = cached_fields.get(self.name)
+        if value is not None and not isinstance(value, KEY_CLASS):
+            return value
+        value = cached_fields[self.name] = instance._decode_field(self.name, self.field)
+        if isinstance(value, (list, dict)):
+            instance._snapshot_field(self.name, value)
+        return value
+
+    def __set__(self, instance, value):
+        instance._set_field(self.name, self.field, value)
+
 
 class DocumentMetaClass(type):
     def __init__(cls, name, bases, classdict):
@@ -494,19 +1354,27 @@ class DocumentMetaClass(type):
             attributes.update(base_class.__dict__)
         attributes.update(cls.__dict__)
         cls._fields = cls.collect_fields(attributes)
+        # fields stored as JSON strings, encoded by save()
+        cls._json_fields = tuple(field_name for field_name, field in cls._fields.iteritems()
+                                 if isinstance(field, DictField))
 
         cls._key_name = cls.__name__
         if GAE_RUNNING:
-            cls._entity = type(cls._key_name, (ndb.Model,), cls._fields)()
+            entity = type(cls._key_name, (ndb.Model,), cls._fields)()
         else:
-            cls._entity = datastore.Entity(key=Key(cls._key_name))
+            entity = datastore.Entity(key=Key(cls._key_name))
 
-        cls.objects = QuerySetManager(cls._entity, cls)
+        for field_name, field in cls._fields.iteritems():
+            setattr(cls, field_name, FieldDescriptor(field_name, field))
+
+        cls.objects = QuerySetManager(entity, cls)
         ALL_DOCUMENTS[cls._key_name] = cls
 
     def collect_fields(cls, attributes):
         fields = {}
         for k, v in attributes.iteritems():
+            if isinstance(v, FieldDescriptor):
+                v = v.field
             if GAE_RUNNING:
                 field_type = ndb.Property
             else:
@@ -518,34 +1386,33 @@ class DocumentMetaClass(type):
 
 
 class Document(object):
+    # state of wrapped entity, subclasses keep __dict__ for their own
+    # attributes unless they declare empty __slots__ too
+    __slots__ = ('_entity', '_cached_fields', '_follow_references', '_changed_fields', '_stored',
+                 '_snapshots')
 
     _projection = ()
 
     _fields = {}
+    _json_fields = ()
     _extra_filters_func = None
-    _follow_references = True
     __metaclass__ = DocumentMetaClass
 
     def __new__(cls, **kwargs):
-#        cls._fields = cls.__collect_fields()
         entity = kwargs.get('entity')
-        follow_references = kwargs.get('follow_references', True)
-
         if entity:
             if GAE_RUNNING:
-                cls._fields = entity._properties
-                entity_cls = ALL_DOCUMENTS[entity._get_kind()]
+                cls = ALL_DOCUMENTS[entity._get_kind()]
             else:
-                cls._fields = dict(entity)
-                entity_cls = ALL_DOCUMENTS[entity.kind]
-            entity_cls._entity = entity
-            entity_cls._follow_references = follow_references
-            return object.__new__(entity_cls)
-        cls._follow_references = follow_references
+                cls = ALL_DOCUMENTS[entity.kind]
         return object.__new__(cls)
 
-    def __init__(self, entity=None, **kwargs):
+    def __init__(self, entity=None, follow_references=True, **kwargs):
         self._cached_fields = {}
+        self._follow_references = follow_references
+        self._changed_fields = set()
+        self._snapshots = {}
+        self._stored = bool(entity)
         if entity:
             self._entity = entity
             self._entity._exclude_from_indexes = getattr(self, '_exclude_from_indexes', set())
@@ -560,7 +1427,7 @@ class Document(object):
         else:
             exclude_indexes = getattr(self, '_exclude_from_indexes', set())
 
-            _id = str(ObjectId())
+            _id = _new_id()
             self._entity = datastore.Entity(key=Key(self._key_name, _id),
                                             exclude_from_indexes=exclude_indexes)
             for k, v in kwargs.iteritems():
@@ -570,7 +1437,13 @@ class Document(object):
         setattr(self, name, value)
 
     def delete(self):
-        self._entity.key.delete()
+        writer = get_bulk_writer()
+        if writer:
+            writer.delete(self._entity.key)
+        else:
+            _delete_multi([self._entity.key])
+        _invalidate_cached([self._entity.key])
+        self._stored = False
 
     @classmethod
     def from_dict(cls, obj):
@@ -595,151 +1468,184 @@ class Document(object):
 
     @classmethod
     def commit_transactions(cls):
-        global ACTIVE_TRANSACTION
-        global TRANSACTION_ENTITIES
-        batch = ACTIVE_TRANSACTION
-        if batch:
-            batch.commit()
-            TRANSACTION_ENTITIES = []
-        ACTIVE_TRANSACTION = None
-
-    def save(self, transactional=False, **kwargs):
-        for field_name, field_obj in self._fields.iteritems():
-            if isinstance(field_obj, DictField):
-                pre_save_func = getattr(field_obj, 'pre_save')
-                if not pre_save_func:
-                    continue
+        """Commits entities saved with "transactional=True" in the current thread."""
+        writer = getattr(_bulk_state, 'transactional_writer', None)
+        if writer:
+            _bulk_state.transactional_writer = None
+            writer.close()
 
-                value = getattr(self, field_name)
-                if isinstance(value, dict):
-                    self._entity[field_name] = pre_save_func(value)
-
-        global ACTIVE_TRANSACTION
-        global TRANSACTION_ENTITIES
-
-        if transactional and not GAE_RUNNING:
-            batch = ACTIVE_TRANSACTION
-            if not batch:
-                batch = datastore.Batch()#Transaction()
-                #transaction.begin()
-                ACTIVE_TRANSACTION = batch
-
-            batch.put(self._entity)
-            TRANSACTION_ENTITIES.append(self._entity)
-            if len(TRANSACTION_ENTITIES) > 200:
-                batch.commit()
-                TRANSACTION_ENTITIES = []
-                ACTIVE_TRANSACTION = None
+    @classmethod
+    def bulk_save(cls, documents, batch_size=MAX_BATCH_MUTATIONS, max_inflight=0):
+        """Saves given documents in batches of "batch_size" entities."""
+        with _writer_scope(batch_size, max_inflight):
+            for doc in documents:
+                doc.save()
+
+    def changed_fields(self):
+        """Names of fields changed since the document was loaded or saved."""
+        self._collect_changes()
+        return set(self._changed_fields)
+
+    def save_async(self, force=False):
+        """
+        Runs save() in the async pool and returns its AsyncResult. The entity
+        is put directly, not by bulk writer or transaction of the calling
+        thread, the document should not be changed until the result is ready.
+        """
+        return run_async(self.save, force=force)
+
+    def delete_async(self):
+        """Runs delete() in the async pool and returns its AsyncResult."""
+        return run_async(self.delete)
+
+    def save(self, transactional=False, force=False, **kwargs):
+        """
+        Puts the entity unless the document was loaded (or saved) and none
+        of its fields changed since, "force=True" puts it anyway.
+        """
+        self._collect_changes()
+
+        writer = get_bulk_writer()
+        if self._stored and not self._changed_fields and not force:
+            if writer:
+                writer.skipped += 1
+            return
+
+        if not writer and transactional and not GAE_RUNNING:
+            # saved entities are committed by batches or by commit_transactions()
+            writer = getattr(_bulk_state, 'transactional_writer', None)
+            if not writer:
+                writer = _bulk_state.transactional_writer = BulkWriter()
+
+        if writer:
+            writer.put(self._entity)
         else:
-            if GAE_RUNNING:
-                self._entity.put()
-            else:
-                datastore.put([self._entity])
+            _put_multi([self._entity])
+        _invalidate_cached([self._entity.key])
+        self._changed_fields.clear()
+        self._stored = True
+        for field_name, value in self._cached_fields.iteritems():
+            if isinstance(value, (list, dict)):
+                self._snapshot_field(field_name, value)
 
     def __getitem__(self, item):
         return getattr(self, item)
 
-    def __getattribute__(self, item):
+    def _snapshot_field(self, field_name, value):
+        """
+        Keeps copy of mutable value shared by the document and its entity
+        (assigned or not decoded), its in-place changes are found by
+        comparing the entity value with the copy.
+        """
+        if field_name not in self._json_fields and _raw_value(self._entity, field_name) is value:
+            if isinstance(value, list) and not any(isinstance(item, (list, dict)) for item in value):
+                # list of scalars or keys
+                self._snapshots[field_name] = list(value)
+            else:
+                self._snapshots[field_name] = copy.deepcopy(value)
+
+    def _collect_changes(self):
+        """Marks fields changed in place since load or save, encodes JSON fields."""
+        for field_name, snapshot in self._snapshots.iteritems():
+            if field_name not in self._changed_fields and \
+                    not _same_value(snapshot, _raw_value(self._entity, field_name)):
+                self._changed_fields.add(field_name)
+        self._encode_json_fields()
+
+    def _encode_json_fields(self):
+        """
+        Encodes values of JSON fields which were assigned or read and changed
+        in place since (compared with decoded stored value, JSON strings of
+        other encoders differ for equal values). Fields never accessed keep
+        JSON string of the entity without being decoded and encoded again.
+        """
+        for field_name in self._json_fields:
+            value = self._cached_fields.get(field_name)
+            if isinstance(value, dict):
+                field = self._fields[field_name]
+                stored = self._entity.get(field_name)
+                if field_name in self._changed_fields or \
+                        value != field.uncast(None if stored == 'None' else stored):
+                    self._entity[field_name] = field.pre_save(value)
+                    self._changed_fields.add(field_name)
+            elif field_name not in self._entity:
+                self._entity[field_name] = EMPTY_JSON
+
+    def _decode_field(self, item, field):
         result = None
-
-        if item != '_fields' and item in object.__getattribute__(self, '_fields'):
-            cached_fields = object.__getattribute__(self, '_cached_fields')
-            if item in cached_fields:
-                value = cached_fields[item]
-
-                if value is not None and not isinstance(value, KEY_CLASS):
-                    return value
-
-            if GAE_RUNNING:
-                if item == 'id':
-                    result = self._entity.key.id()
-                else:
-                    value = getattr(self._entity, item)
-                    if value == 'None':
-                        value = None
-                    if isinstance(value, list):
-                        result = []
-                        if self._follow_references:
-                            if len(value) > 0 and isinstance(value[0], ndb.Key):
-                                try:
-                                    result = [_wrap_document(ent) for ent in ndb.get_multi(value)]
-                                except Exception as e:
-                                    logging.error('Wrong keys %s: %s' % (str(value), e))
-                            else:
-                                result = value
-                        else:
-                            if isinstance(value, list) and len(value)>0 and isinstance(value[0], (unicode, str)):
-                                result = [item for item in value]
-                            else:
-                                result = [key.id() for key in value]
-                    elif isinstance(value, ndb.Key):
-                        if self._follow_references:
+        if GAE_RUNNING:
+            if item == 'id':
+                result = self._entity.key.id()
+            else:
+                value = getattr(self._entity, item)
+                if value == 'None':
+                    value = None
+                if isinstance(value, list):
+                    result = []
+                    if self._follow_references:
+                        if len(value) > 0 and isinstance(value[0], ndb.Key):
                             try:
-                                result = value.get()
+                                result = [_wrap_document(ent) for ent in _get_multi(value)]
                             except Exception as e:
-                                logging.error('Wrong key %s: %s' % (str(value), e))
-                            result = _wrap_document(result)
+                                logging.error('Wrong keys %s: %s' % (str(value), e))
                         else:
-                            result = value.id()
+                            result = value
                     else:
-                        result = value
-            else:
-                if item == 'id':
-                    result = self._entity.key.id or self._entity.key.name
-                else:
-                    value = self._entity.get(item)
-
-                    if value == 'None':
-                        value = None
-                    if isinstance(value, datetime):
-                         value = value.replace(tzinfo=None)
-
-                    field = self._fields[item]
-                    if item != 'account' and hasattr(field, 'uncast'):
-                        result = field.uncast(value,
-                                              follow_references=self._follow_references)
+                        if isinstance(value, list) and len(value)>0 and isinstance(value[0], (unicode, str)):
+                            result = [item for item in value]
+                        else:
+                            result = [key.id() for key in value]
+                elif isinstance(value, ndb.Key):
+                    if self._follow_references:
+                        try:
+                            result = _get_multi([value])[0]
+                        except Exception as e:
+                            logging.error('Wrong key %s: %s' % (str(value), e))
+                        result = _wrap_document(result)
                     else:
-                        result = value
-
-            cached_fields[item] = result
-        elif item == 'id':
-            key = getattr(self._entity, 'key')
-            if key:
-                if isinstance(key.id, (int, long)):
-                    result = key.id
+                        result = value.id()
                 else:
-                    result = key.id()
+                    result = value
         else:
-            val = object.__getattribute__(self, item)
-            if val == 'None':
-                val = None
-            result = val
+            if item == 'id':
+                result = self._entity.key.id or self._entity.key.name
+            else:
+                value = self._entity.get(item)
+
+                if value == 'None':
+                    value = None
+                if isinstance(value, datetime):
+                     value = value.replace(tzinfo=None)
 
+                if item != 'account' and hasattr(field, 'uncast'):
+                    result = field.uncast(value,
+                                          follow_references=self._follow_references)
+                else:
+                    result = value
         return result
 
-    def __setattr__(self, key, value):
-        if key not in self._fields:
-            self.__dict__[key] = value
+    def _set_field(self, key, field, value):
+        if hasattr(field, 'cast'):
+            casted_val = field.cast(value, follow_references=self._follow_references)
+            if key not in self._entity or not _same_value(self._entity[key], casted_val):
+                self._changed_fields.add(key)
+            self._entity[key] = casted_val
+            self._cached_fields[key] = casted_val
         else:
-            field = self._fields[key]
-            if hasattr(field, 'cast'):
-                casted_val = field.cast(value, follow_references=self._follow_references)
-                self._entity[key] = casted_val
-                self._cached_fields[key] = casted_val
+            if isinstance(value, Document):
+                value = value._entity.key
+            elif isinstance(value, list):
+                output_values = []
+                for val in value:
+                    if isinstance(val, Document):
+                        output_values.append(val._entity.key)
+                value = output_values
+            if isinstance(field, ndb.KeyProperty) and isinstance(value, (str, unicode)):
+                setattr(self._entity, key, ndb.Key(field.kind, value))
             else:
-                if isinstance(value, Document):
-                    value = value._entity.key
-                elif isinstance(value, list):
-                    output_values = []
-                    for val in value:
-                        if isinstance(val, Document):
-                            output_values.append(val._entity.key)
-                    value = output_values
-                if isinstance(field, ndb.KeyProperty) and isinstance(value, (str, unicode)):
-                    setattr(self._entity, key, ndb.Key(field.kind, value))
-                else:
-                    setattr(self._entity, key, value)
-                self._cached_fields[key] = value
+                setattr(self._entity, key, value)
+            self._cached_fields[key] = value
+            self._changed_fields.add(key)
 
 
 class DynamicDocument(Document):
@@ -0,0 +1,521 @@
+"""
+In-process datastore emulator with the subset of "gcloud.datastore" API used
+by datastore_documents (keys, entities, get/put/delete, batches,
+transactions and queries with filters, ordering, projection, offsets and
+cursors), so documents can be load-tested and benchmarked without a live
+service:
+
+    import datastore_documents
+    from datastore_local import LocalDatastore
+
+    datastore_documents.set_backend(LocalDatastore())
+
+or set DATASTORE_BACKEND=local before datastore_documents is imported.
+
+Entities are kept in dicts per kind. Every indexed property has an index
+of keys by value with sorted list of values, it serves the first equality
+or range filter of a query; the other filters are checked against the
+entities.
+"""
+import base64
+from bisect import bisect_left, bisect_right, insort
+from datetime import datetime
+import itertools
+import pickle
+import threading
+
+
+# operators of query filters
+OPERATORS = ('=', '<', '<=', '>', '>=', '!=', 'in')
+
+# number of distinct queries which sorted results are kept for
+RESULTS_CACHE_SIZE = 32
+
+
+class Key(object):
+    """Key of an entity: flat path of kinds and ids/names, the last id may be missing."""
+
+    def __init__(self, *path_args, **kwargs):
+        if not path_args:
+            raise ValueError('Key must have at least a kind')
+        self.flat_path = tuple(path_args)
+        self.namespace = kwargs.get('namespace')
+        self.dataset_id = kwargs.get('dataset_id')
+
+    @property
+    def kind(self):
+        return self.flat_path[-1] if self.is_partial else self.flat_path[-2]
+
+    @property
+    def is_partial(self):
+        return len(self.flat_path) % 2 == 1
+
+    @property
+    def id_or_name(self):
+        return None if self.is_partial else self.flat_path[-1]
+
+    @property
+    def id(self):
+        value = self.id_or_name
+        return value if isinstance(value, (int, long)) else None
+
+    @property
+    def name(self):
+        value = self.id_or_name
+        return value if isinstance(value, basestring) else None
+
+    @property
+    def parent(self):
+        path = self.flat_path[:-1] if self.is_partial else self.flat_path[:-2]
+        return Key(*path) if path else None
+
+    def completed_key(self, id_or_name):
+        return Key(*(self.flat_path + (id_or_name,)), namespace=self.namespace,
+                   dataset_id=self.dataset_id)
+
+    def __eq__(self, other):
+        return isinstance(other, Key) and self.flat_path == other.flat_path
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.flat_path)
+
+    def __repr__(self):
+        return '<Key%r>' % (self.flat_path,)
+
+
+class Entity(dict):
+    """Properties of an entity with its key."""
+
+    def __init__(self, key=None, exclude_from_indexes=()):
+        super(Entity, self).__init__()
+        self.key = key
+        self._exclude_from_indexes = set(exclude_from_indexes)
+
+    @property
+    def kind(self):
+        return self.key.kind if self.key else None
+
+    @property
+    def exclude_from_indexes(self):
+        return frozenset(self._exclude_from_indexes)
+
+    def __repr__(self):
+        return '<Entity%r %s>' % (self.key and self.key.flat_path, super(Entity, self).__repr__())
+
+
+def _index_value(value):
+    """
+    Sortable representation of a property value in datastore order: null,
+    numbers, timestamps, booleans, strings, keys.
+    """
+    if value is None:
+        return (0, None)
+    if isinstance(value, bool):
+        return (3, value)
+    if isinstance(value, (int, long, float)):
+        return (1, value)
+    if isinstance(value, datetime):
+        return (2, value.replace(tzinfo=None))
+    if isinstance(value, basestring):
+        return (4, value if isinstance(value, unicode) else value.decode('utf-8', 'replace'))
+    if isinstance(value, Key):
+        return (5, value.flat_path)
+    return (6, repr(value))
+
+
+def _index_values(value):
+    """Values of the property in index: every item of a list is indexed separately."""
+    if isinstance(value, (list, tuple)):
+        return set(_index_value(item) for item in value)
+    return set([_index_value(value)])
+
+
+def _copy(entity, properties=None):
+    copy = Entity(key=entity.key, exclude_from_indexes=entity._exclude_from_indexes)
+    for name, value in entity.iteritems():
+        if properties is None or name in properties:
+            copy[name] = list(value) if isinstance(value, list) else value
+    return copy
+
+
+class _Descending(object):
+    """Wraps sortable value to invert its order."""
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+    def __getstate__(self):
+        return self.value
+
+    def __setstate__(self, state):
+        self.value = state
+
+
+def _matches(values, operator, value):
+    if operator == 'in':
+        return bool(values & set(_index_value(v) for v in value))
+    value = _index_value(value)
+    if operator == '=':
+        return value in values
+    if operator == '!=':
+        return any(v != value for v in values)
+    if operator == '<':
+        return any(v < value for v in values)
+    if operator == '<=':
+        return any(v <= value for v in values)
+    if operator == '>':
+        return any(v > value for v in values)
+    if operator == '>=':
+        return any(v >= value for v in values)
+    raise ValueError('Unknown operator of query filter: %s' % operator)
+
+
+class Query(object):
+    """Query of entities of one kind, attributes are the same as of gcloud query."""
+
+    def __init__(self, kind=None, dataset_id=None, namespace=None, ancestor=None,
+                 filters=(), projection=(), order=(), group_by=(), store=None):
+        self._store = store
+        self.kind = kind
+        self.dataset_id = dataset_id
+        self.namespace = namespace
+        self.ancestor = ancestor
+        self.filters = list(filters)
+        self.projection = list(projection)
+        self.order = list(order)
+        self.group_by = list(group_by)
+
+    def add_filter(self, property_name, operator, value):
+        if operator not in OPERATORS:
+            raise ValueError('Unknown operator of query filter: %s' % operator)
+        self.filters.append((property_name, operator, value))
+
+    def keys_only(self):
+        self.projection = ['__key__']
+
+    def fetch(self, limit=None, offset=0, start_cursor=None, end_cursor=None, connection=None):
+        return Iterator(self, limit=limit, offset=offset, start_cursor=start_cursor)
+
+    def __iter__(self):
+        return iter(self.fetch())
+
+
+class Iterator(object):
+    """Results of a query fetched page by page with next_page()."""
+
+    def __init__(self, query, limit=None, offset=0, start_cursor=None):
+        self._query = query
+        self._limit = limit
+        self._offset = offset or 0
+        self._cursor = start_cursor
+        self._more_results = True
+
+    def next_page(self):
+        entities, self._more_results, self._cursor = self._query._store.run_query(
+            self._query, self._limit, self._offset, self._cursor)
+        self._offset = 0
+        return entities, self._more_results, self._cursor
+
+    def __iter__(self):
+        # the first page holds all results up to the limit
+        entities, _, _ = self.next_page()
+        return iter(entities)
+
+
+class Batch(object):
+    """Mutations applied together by commit()."""
+
+    def __init__(self, store):
+        self._store = store
+        self._puts = []
+        self._deletes = []
+
+    def put(self, entity):
+        self._puts.append(entity)
+
+    def delete(self, key):
+        self._deletes.append(key)
+
+    def begin(self):
+        self._store._push_batch(self)
+
+    def commit(self):
+        self._store._remove_batch(self)
+        self._store._apply(self._puts, self._deletes)
+        self._puts, self._deletes = [], []
+
+    def rollback(self):
+        self._store._remove_batch(self)
+        self._puts, self._deletes = [], []
+
+    def __enter__(self):
+        self.begin()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
+
+
+class Transaction(Batch):
+    """
+    Batch collecting put() and delete() calls of the current thread from
+    begin() until commit() or rollback(). Unlike a real transaction it does
+    not detect conflicting writes of other threads.
+    """
+
+
+class LocalDatastore(object):
+    """
+    In-memory datastore. Instances are independent, module functions of
+    gcloud.datastore (get, put, delete, Query, Batch, Transaction) are its
+    methods.
+    """
+    Key = Key
+    Entity = Entity
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._local = threading.local()
+        # kind -> key path -> entity
+        self._entities = {}
+        # (kind, property) -> ({index value: key paths}, sorted index values)
+        self._indexes = {}
+        self._ids = itertools.count(1)
+        # incremented by every mutation, invalidates cached query results
+        self._version = 0
+        self._results_cache = {}
+        self.stats = {'get': 0, 'put': 0, 'delete': 0, 'query': 0}
+
+    # mutations
+
+    def _current_batch(self):
+        batches = getattr(self._local, 'batches', None)
+        return batches[-1] if batches else None
+
+    def _push_batch(self, batch):
+        if not hasattr(self._local, 'batches'):
+            self._local.batches = []
+        self._local.batches.append(batch)
+
+    def _remove_batch(self, batch):
+        batches = getattr(self._local, 'batches', [])
+        if batch in batches:
+            batches.remove(batch)
+
+    def _unindex(self, entity):
+        for name, value in entity.iteritems():
+            index = self._indexes.get((entity.key.kind, name))
+            if index is None:
+                continue
+            paths_by_value, values = index
+            for index_value in _index_values(value):
+                paths = paths_by_value.get(index_value)
+                if paths is None:
+                    continue
+                paths.discard(entity.key.flat_path)
+                if not paths:
+                    del paths_by_value[index_value]
+                    del values[bisect_left(values, index_value)]
+
+    def _index(self, entity):
+        for name, value in entity.iteritems():
+            if name in entity._exclude_from_indexes:
+                continue
+            paths_by_value, values = self._indexes.setdefault((entity.key.kind, name), ({}, []))
+            for index_value in _index_values(value):
+                paths = paths_by_value.get(index_value)
+                if paths is None:
+                    paths = paths_by_value[index_value] = set()
+                    insort(values, index_value)
+                paths.add(entity.key.flat_path)
+
+    def _apply(self, puts, deletes):
+        with self._lock:
+            for entity in puts:
+                if entity.key.is_partial:
+                    entity.key = entity.key.completed_key(next(self._ids))
+                stored = _copy(entity)
+                entities = self._entities.setdefault(stored.key.kind, {})
+                previous = entities.get(stored.key.flat_path)
+                if previous is not None:
+                    self._unindex(previous)
+                entities[stored.key.flat_path] = stored
+                self._index(stored)
+            for key in deletes:
+                previous = self._entities.get(key.kind, {}).pop(key.flat_path, None)
+                if previous is not None:
+                    self._unindex(previous)
+            self.stats['put'] += len(puts)
+            self.stats['delete'] += len(deletes)
+            self._version += 1
+
+    def put(self, entities, connection=None):
+        batch = self._current_batch()
+        if batch:
+            for entity in entities:
+                batch.put(entity)
+        else:
+            self._apply(entities, [])
+
+    def delete(self, keys, connection=None):
+        batch = self._current_batch()
+        if batch:
+            for key in keys:
+                batch.delete(key)
+        else:
+            self._apply([], keys)
+
+    def get(self, keys, missing=None, connection=None):
+        """Returns found entities only (like gcloud), missing keys are appended to "missing"."""
+        with self._lock:
+            self.stats['get'] += len(keys)
+            results = []
+            for key in keys:
+                entity = self._entities.get(key.kind, {}).get(key.flat_path)
+                if entity is not None:
+                    results.append(_copy(entity))
+                elif missing is not None:
+                    missing.append(key)
+            return results
+
+    def Batch(self, connection=None):
+        return Batch(self)
+
+    def Transaction(self, connection=None):
+        return Transaction(self)
+
+    def Query(self, kind=None, **kwargs):
+        return Query(kind, store=self, **kwargs)
+
+    # queries
+
+    def _candidates(self, query):
+        """Key paths of entities matching the first indexable filter of the query."""
+        for name, operator, value in query.filters:
+            if name == '__key__' or operator in ('!=', 'in'):
+                continue
+            paths_by_value, values = self._indexes.get((query.kind, name), ({}, []))
+            value = _index_value(value)
+            if operator == '=':
+                return paths_by_value.get(value, ())
+            if operator == '>':
+                matched = values[bisect_right(values, value):]
+            elif operator == '>=':
+                matched = values[bisect_left(values, value):]
+            elif operator == '<':
+                matched = values[:bisect_left(values, value)]
+            else:
+                matched = values[:bisect_right(values, value)]
+            paths = set()
+            for index_value in matched:
+                paths.update(paths_by_value[index_value])
+            return paths
+        return self._entities.get(query.kind, {}).keys()
+
+    def _match(self, entity, filters):
+        for name, operator, value in filters:
+            if name == '__key__':
+                values = set([_index_value(entity.key)])
+            elif name not in entity or name in entity._exclude_from_indexes:
+                # entities without indexed property are not in the index
+                return False
+            else:
+                values = _index_values(entity[name])
+            if not _matches(values, operator, value):
+                return False
+        return True
+
+    def _sort_key(self, entity, order):
+        values = []
+        for name in order:
+            descending = name.startswith('-')
+            name = name.lstrip('-')
+            if name == '__key__':
+                value = _index_value(entity.key)
+            else:
+                value = _index_value(entity[name]) if not isinstance(entity[name], list) else \
+                    (max if descending else min)(_index_values(entity[name]))
+            values.append(_Descending(value) if descending else value)
+        values.append(entity.key.flat_path)
+        return tuple(values)
+
+    def _sorted_results(self, query):
+        """
+        Returns sort keys and entities matching the query in its order.
+        Results are cached until the next mutation, so pages of the same
+        query resumed from cursors do not scan and sort the kind again.
+        """
+        order = tuple(name for name in query.order if name)
+        signature = (query.kind, repr(query.filters), order,
+                     query.ancestor.flat_path if query.ancestor else None)
+        cached = self._results_cache.get(signature)
+        if cached and cached[0] == self._version:
+            return cached[1], cached[2]
+
+        entities = self._entities.get(query.kind, {})
+        required = [name.lstrip('-') for name in order if name.lstrip('-') != '__key__']
+        results = []
+        for path in self._candidates(query):
+            entity = entities.get(path)
+            if entity is None or not self._match(entity, query.filters):
+                continue
+            if query.ancestor and entity.key.flat_path[:len(query.ancestor.flat_path)] != \
+                    query.ancestor.flat_path:
+                continue
+            if any(name not in entity or name in entity._exclude_from_indexes for name in required):
+                continue
+            results.append((self._sort_key(entity, order), entity))
+        results.sort(key=lambda item: item[0])
+        sort_keys = [sort_key for sort_key, _ in results]
+        entities = [entity for _, entity in results]
+
+        if len(self._results_cache) >= RESULTS_CACHE_SIZE:
+            self._results_cache.clear()
+        self._results_cache[signature] = (self._version, sort_keys, entities)
+        return sort_keys, entities
+
+    def run_query(self, query, limit=None, offset=0, cursor=None):
+        """Returns (entities, more results, cursor) of one page of query results."""
+        with self._lock:
+            self.stats['query'] += 1
+            sort_keys, entities = self._sorted_results(query)
+
+            start = 0
+            if cursor:
+                start = bisect_right(sort_keys, pickle.loads(base64.b64decode(cursor)))
+            start += offset or 0
+            end = len(entities) if limit is None else min(start + limit, len(entities))
+            # like the real backend which reports MORE_RESULTS_AFTER_LIMIT
+            # (mapped to more_results=False by gcloud) for every limited query
+            more_results = False
+
+            next_cursor = cursor
+            if end > start:
+                next_cursor = base64.b64encode(pickle.dumps(sort_keys[end - 1], pickle.HIGHEST_PROTOCOL))
+
+            projection = [name for name in query.projection if name != '__key__']
+            if query.projection:
+                page = [_copy(entity, projection) for entity in entities[start:end]]
+            else:
+                page = [_copy(entity) for entity in entities[start:end]]
+            return page, more_results, next_cursor
+
+    def clear(self):
+        with self._lock:
+            self._entities.clear()
+            self._indexes.clear()
+            self._results_cache.clear()
+            self._version += 1
@@ -1,16 +1,24 @@
+from datetime import datetime, timedelta
 import logging
 from optparse import OptionParser
+import socket
 import sys
+import time
 
 import sqlalchemy
 
 from scheduler_config import *
+from daemon import SchedulerDaemon
 from models import BaseModel
+from retention import DEFAULT_KEEP_RAW_DAYS, compact_history
 from scheduler import AppScheduler
+from sharding import HashRing
+from stats import EXPORTERS, run_stats
 
 
 if __name__ == '__main__':
-    opt = OptionParser(usage='usage: %prog [options] app_name')
+    opt = OptionParser(usage='usage: %prog [options] app_name\n'
+                             '       %prog [options] --daemon')
 
     opt.add_option("-l", "--log_level", dest="log_level", default='INFO',
                       help="verbosity log level (default INFO)")
@@ -20,16 +28,46 @@ if __name__ == '__main__':
     opt.add_option("-i", "--init",
                       action="store_true", dest="init", default=True,
                       help="initialize scheduler storage")
+    opt.add_option("-d", "--daemon",
+                      action="store_true", dest="daemon", default=False,
+                      help="run all scheduled applications from one long-running process "
+                           "(except ones with 'enabled': False)")
+    opt.add_option("-w", "--workers", dest="workers", type="int", default=4,
+                      help="number of applications run in parallel in daemon mode (default 4)")
+    opt.add_option("--hosts", dest="hosts", default=None,
+                      help="comma-separated names of all runner hosts to shard applications across")
+    opt.add_option("--host", dest="host", default=socket.gethostname(),
+                      help="name of this runner host within --hosts (default hostname)")
+    opt.add_option("-r", "--report", dest="report", default=None,
+                      help="write run statistics of all applications to given file ('-' for stdout)")
+    opt.add_option("--report_format", dest="report_format", default='prometheus',
+                      help="format of the report: %s (default prometheus)" % ', '.join(sorted(EXPORTERS)))
+    opt.add_option("--report_window", dest="report_window", type="int", default=24,
+                      help="hours of run history included into the report (default 24)")
+    opt.add_option("-c", "--compact",
+                      action="store_true", dest="compact", default=False,
+                      help="roll old run history up into hourly and daily aggregates")
+    opt.add_option("--keep_days", dest="keep_days", type="int", default=DEFAULT_KEEP_RAW_DAYS,
+                      help="days raw run history is kept for by --compact (default %d)" % DEFAULT_KEEP_RAW_DAYS)
 
 
     (options, args) = opt.parse_args()
 
-    if not args:
+    if options.daemon or options.report or options.compact:
+        app_name = None
+    elif not args:
         sys.exit('Application is not specified!')
     else:
         app_name = args[0]
 
     log_level = options.log_level.upper()
+    hosts = options.hosts.split(',') if options.hosts else None
+    if hosts and options.host not in hosts:
+        sys.exit('Host %s is not one of --hosts' % options.host)
+
+    if options.report and options.report_format not in EXPORTERS:
+        sys.exit('Unknown report format: %s' % options.report_format)
+
     if not log_level in ['DEBUG', 'INFO', 'WARNING', 'WARN', 'ERROR', 'CRITICAL']:
         sys.exit('Unknown log level specified: %s' % log_level)
 
@@ -42,8 +80,9 @@ if __name__ == '__main__':
         logger.debug('Initializing database engine')
         engine = sqlalchemy.create_engine(
             '%(dialect)s://%(user)s:%(password)s@%(host)s/%(database)s' % APP_SCHEDULER_DB,
-            max_overflow=0)
-        session = sqlalchemy.orm.sessionmaker(bind=engine)()
+            max_overflow=0,
+            pool_size=max(options.workers, 5) if options.daemon else 5)
+        session_factory = sqlalchemy.orm.sessionmaker(bind=engine)
 
         if options.init:
             BaseModel.metadata.create_all(bind=engine)
@@ -52,21 +91,41 @@ if __name__ == '__main__':
         logger.exception('Cannot connect to DB: %s' % e)
         sys.exit(1)
 
-    scheduler = AppScheduler(app_name, APP_SCHEDULE, session)
+    if options.compact:
+        raw_rows, hourly_rows = compact_history(session_factory(), keep_raw_days=options.keep_days)
+        logger.info('Compacted %d run history rows and %d hourly aggregates', raw_rows, hourly_rows)
+        sys.exit(0)
+
+    if options.report:
+        now = datetime.now()
+        stats = run_stats(session_factory(), since=now - timedelta(hours=options.report_window), until=now)
+        if options.report == '-':
+            EXPORTERS[options.report_format](stats, sys.stdout)
+        else:
+            with open(options.report, 'w') as stream:
+                EXPORTERS[options.report_format](stats, stream)
+        logger.info('Run statistics of %d applications written to %s', len(stats), options.report)
+        sys.exit(0)
+
+    if options.daemon:
+        daemon = SchedulerDaemon(APP_SCHEDULE, session_factory, workers=options.workers,
+                                 host=options.host, hosts=hosts)
+        try:
+            daemon.run()
+        except KeyboardInterrupt:
+            logger.info('App Scheduler daemon stopped')
+        sys.exit(0)
+
+    if hosts and not options.force and HashRing(hosts).owner(app_name) != options.host:
+        logger.info('Application %s is run by another host', app_name)
+        sys.exit(0)
+
+    scheduler = AppScheduler(app_name, APP_SCHEDULE, session_factory())
     logger.info('Initialized scheduler for application %s', app_name)
+    if scheduler.jitter and not options.force:
+        time.sleep(scheduler.jitter)
     try:
-        if options.force or scheduler.should_start():
-            logger.info('Ready to start application: %s', app_name)
-            error = ''
-            try:
-                try:
-                    if scheduler.lock():
-                        scheduler.run()
-                except Exception as e:
-                    error = str(e)
-                    raise
-            finally:
-                scheduler.unlock(error)
+        scheduler.start(force=options.force)
     except Exception as e:
         logger.exception('Runtime error in scheduler: %s' % e)
         sys.exit(1)
@@ -0,0 +1,179 @@
+from datetime import date, datetime, timedelta
+
+from utils import get_date_struct, get_datetime_struct
+
+
+SCHEDULE_FIELDS = ('months', 'month_week', 'days', 'week_days', 'hours', 'minutes')
+
+# how far next fire time is searched for (covers leap years)
+SEARCH_HORIZON_DAYS = 366 * 8
+
+
+def _compile_field(value):
+    if value is None or value == '*':
+        return None
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return frozenset(int(v) for v in value)
+    return frozenset([int(value)])
+
+
+def _next_month(day):
+    return date(day.year + day.month // 12, day.month % 12 + 1, 1)
+
+
+class CronSchedule(object):
+    """
+    Application schedule compiled once from its configuration: every field
+    ("months", "month_week", "days", "week_days", "hours", "minutes") is '*',
+    a number or a list of numbers. Days and month weeks after the end of the
+    month match the last day/week of the month.
+
+    Every matching minute belongs to a slot: the year, actual values of the
+    fields up to the first configured one and values of configured fields
+    (e.g. with hours=[3] all minutes of 3 o'clock make one slot).
+    Application fires at the first matching minute of a slot that differs
+    from the slot of its last start.
+    """
+
+    def __init__(self, months='*', month_week='*', days='*', week_days='*',
+                 hours='*', minutes='*'):
+        self.months = _compile_field(months)
+        self.month_week = _compile_field(month_week)
+        self.days = _compile_field(days)
+        self.week_days = _compile_field(week_days)
+        self.hours = _compile_field(hours)
+        self.minutes = _compile_field(minutes)
+
+        self._max_day = max(self.days) if self.days else None
+        self._max_mweek = max(self.month_week) if self.month_week else None
+        self._sorted_hours = sorted(self.hours) if self.hours is not None else range(24)
+        self._sorted_minutes = sorted(self.minutes) if self.minutes is not None else range(60)
+        # matching minutes of the day (hour * 60 + minute)
+        self._day_minutes = None
+        if self.hours is not None or self.minutes is not None:
+            self._day_minutes = frozenset(hour * 60 + minute for hour in self._sorted_hours
+                                          for minute in self._sorted_minutes)
+
+        fields = (self.months, self.month_week, self.days, self.week_days,
+                  self.hours, self.minutes)
+        first_set = len(fields)
+        for i, field in enumerate(fields):
+            if field is not None:
+                first_set = i
+                break
+        # fields which keep their actual value in the slot
+        self._in_slot = tuple(i <= first_set or field is not None
+                              for i, field in enumerate(fields))
+
+    @classmethod
+    def from_config(cls, app_conf):
+        return cls(**dict((field, app_conf.get(field, '*')) for field in SCHEDULE_FIELDS))
+
+    def _match_date(self, month, mweek, mday, last_mday, last_mweek, wday):
+        if self.months is not None and month not in self.months:
+            return False
+        if self.month_week is not None and mweek not in self.month_week and \
+                not (mweek == last_mweek and self._max_mweek > last_mweek):
+            return False
+        if self.days is not None and mday not in self.days and \
+                not (mday == last_mday and self._max_day > last_mday):
+            return False
+        if self.week_days is not None and wday not in self.week_days:
+            return False
+        return True
+
+    def _date_slot(self, year, month, mweek, mday, wday):
+        in_slot = self._in_slot
+        return (year,
+                month if in_slot[0] else '*',
+                mweek if in_slot[1] else '*',
+                mday if in_slot[2] else '*',
+                wday if in_slot[3] else '*')
+
+    def match_struct(self, struct):
+        """
+        Returns slot of the minute described by get_datetime_struct()
+        structure or None if the schedule does not match it.
+        """
+        if self._day_minutes is not None and struct[7] * 60 + struct[8] not in self._day_minutes:
+            return None
+        year, month, mweek, mday, last_mday, last_mweek, wday, hour, minute = struct
+        # same checks as _match_date(), inlined as this is the hot path
+        if self.months is not None and month not in self.months:
+            return None
+        if self.week_days is not None and wday not in self.week_days:
+            return None
+        if self.days is not None and mday not in self.days and \
+                not (mday == last_mday and self._max_day > last_mday):
+            return None
+        if self.month_week is not None and mweek not in self.month_week and \
+                not (mweek == last_mweek and self._max_mweek > last_mweek):
+            return None
+        in_slot = self._in_slot
+        return (year,
+                month if in_slot[0] else '*',
+                mweek if in_slot[1] else '*',
+                mday if in_slot[2] else '*',
+                wday if in_slot[3] else '*',
+                hour if in_slot[4] else '*',
+                minute if in_slot[5] else '*')
+
+    def match(self, timestamp):
+        return self.match_struct(get_datetime_struct(timestamp))
+
+    def match_datetime(self, value):
+        return self.match_struct(get_date_struct(value) + (value.hour, value.minute))
+
+    def _next_in_day(self, day, after_minute, after_slot):
+        year, month, mweek, mday, last_mday, last_mweek, wday = get_date_struct(day)
+        if not self._match_date(month, mweek, mday, last_mday, last_mweek, wday):
+            return None
+        date_slot = self._date_slot(year, month, mweek, mday, wday)
+        hour_in_slot, minute_in_slot = self._in_slot[4:]
+        if after_slot and date_slot == after_slot[:5] and not hour_in_slot and not minute_in_slot:
+            # the whole day belongs to the slot of the last start
+            return None
+
+        for hour in self._sorted_hours:
+            if hour * 60 + 59 <= after_minute:
+                continue
+            for minute in self._sorted_minutes:
+                if hour * 60 + minute <= after_minute:
+                    continue
+                slot = date_slot + (hour if hour_in_slot else '*',
+                                    minute if minute_in_slot else '*')
+                if slot != after_slot:
+                    return datetime(day.year, day.month, day.day, hour, minute)
+                if not minute_in_slot:
+                    # the rest of the hour belongs to the same slot
+                    break
+        return None
+
+    def next_fire_time(self, after):
+        """
+        Returns the first minute after given datetime when application
+        started at that time should start again (or None if there is no such
+        minute within SEARCH_HORIZON_DAYS).
+        """
+        after = after.replace(second=0, microsecond=0)
+        after_slot = self.match_datetime(after)
+        after_minute = after.hour * 60 + after.minute
+        day = after.date()
+        for _ in xrange(SEARCH_HORIZON_DAYS):
+            if self.months is not None and day.month not in self.months:
+                day = _next_month(day)
+                after_minute = -1
+                continue
+            fire_time = self._next_in_day(day, after_minute, after_slot)
+            if fire_time:
+                return fire_time
+            day += timedelta(days=1)
+            after_minute = -1
+        return None
+
+    def fire_times(self, start, end):
+        """Yields fire times after "start" up to "end" (inclusive)."""
+        fire_time = self.next_fire_time(start)
+        while fire_time and fire_time <= end:
+            yield fire_time
+            fire_time = self.next_fire_time(fire_time)
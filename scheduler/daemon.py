@@ -0,0 +1,174 @@
+from datetime import datetime, timedelta
+import heapq
+import logging
+import Queue
+import threading
+
+from scheduler import NOT_CHECKED, AppScheduler, due_applications
+from sharding import HashRing
+
+
+# maximum time daemon sleeps without re-checking its timers (secs)
+MAX_SLEEP = 60
+
+
+class SchedulerDaemon(object):
+    """
+    Drives all applications from scheduling configuration in one process.
+
+    Applications are kept in a heap ordered by their next fire time, the
+    daemon sleeps until the earliest one and dispatches due applications to
+    a pool of "workers" threads. State of all applications due at the same
+    time is checked with one query. Every run gets its own session from
+    "session_factory" so all workers share one engine and connection pool.
+    Up to "workers" applications run concurrently; applications with
+    "exec_mode" 'process' are isolated from the daemon and each other.
+    Applications whose configuration sets "enabled" to False are skipped.
+
+    If names of all runner "hosts" are given, applications are spread
+    across them with consistent hashing and the daemon runs only the shard
+    of its own "host", so hosts do not race for the same locks. Every
+    application start is delayed by its "jitter".
+    """
+
+    def __init__(self, sched_conf, session_factory, workers=4, host=None, hosts=None):
+        self._log = logging.getLogger('scheduler-daemon')
+        self.sched_conf = sched_conf
+        self.session_factory = session_factory
+        self.workers = workers
+        # applications switched off with 'enabled': False are not scheduled
+        self.app_names = sorted(app_name for app_name, app_conf in sched_conf.iteritems()
+                                if app_conf.get('enabled', True))
+        if hosts:
+            self.app_names = HashRing(hosts).shard(self.app_names, host)
+        self._timers = []
+        self._queue = Queue.Queue()
+        self._condition = threading.Condition()
+        self._stopped = False
+        self._threads = []
+
+    def _schedule(self, fire_time, app_name):
+        with self._condition:
+            heapq.heappush(self._timers, (fire_time, app_name))
+            self._condition.notify()
+
+    def _next_fire_time(self, scheduler, failed):
+        now = datetime.now()
+        if scheduler.frequency:
+            # should_start() requires strictly more than "frequency" secs since last start,
+            # jitter is kept from the first start
+            fire_time = now + timedelta(seconds=int(scheduler.frequency) + 1)
+        else:
+            fire_time = scheduler.schedule.next_fire_time(now)
+            if fire_time:
+                fire_time += timedelta(seconds=scheduler.jitter)
+        if failed:
+            # should_start() decides if retry limit allows to run it again
+            retry_time = now + timedelta(seconds=scheduler.retry_delay)
+            fire_time = min(fire_time or retry_time, retry_time)
+        return fire_time
+
+    def _run_app(self, app_name, checked_start):
+        session = self.session_factory()
+        failed = False
+        try:
+            scheduler = AppScheduler(app_name, self.sched_conf, session)
+            try:
+                # application found due by dispatcher is locked only if it was
+                # not started by another host since it was checked
+                scheduler.start(force=checked_start is not NOT_CHECKED, last_started=checked_start)
+            except Exception as e:
+                failed = True
+                self._log.exception('Runtime error in application %s: %s' % (app_name, e))
+            return self._next_fire_time(scheduler, failed)
+        finally:
+            session.close()
+
+    def _work(self):
+        while True:
+            task = self._queue.get()
+            if task is None:
+                return
+            app_name, checked_start = task
+            fire_time = None
+            try:
+                fire_time = self._run_app(app_name, checked_start)
+            except Exception as e:
+                self._log.exception('Cannot schedule application %s: %s' % (app_name, e))
+                fire_time = datetime.now() + timedelta(seconds=MAX_SLEEP)
+            self._reschedule(app_name, fire_time)
+
+    def _reschedule(self, app_name, fire_time):
+        if fire_time:
+            self._log.debug('Next start of application %s at %s', app_name, fire_time)
+            self._schedule(fire_time, app_name)
+        else:
+            self._log.warning('Application %s has no next start time', app_name)
+
+    def run(self):
+        for _ in xrange(self.workers):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+        now = datetime.now()
+        for app_name in self.app_names:
+            jitter = AppScheduler(app_name, self.sched_conf, None).jitter
+            self._schedule(now + timedelta(seconds=jitter), app_name)
+        self._log.info('Scheduler daemon started for %d of %d applications with %d workers',
+                       len(self.app_names), len(self.sched_conf), self.workers)
+
+        try:
+            self._dispatch()
+        finally:
+            self.stop()
+            for _ in self._threads:
+                self._queue.put(None)
+            for thread in self._threads:
+                thread.join()
+            self._threads = []
+
+    def _dispatch(self):
+        while True:
+            with self._condition:
+                while not self._stopped:
+                    now = datetime.now()
+                    if self._timers and self._timers[0][0] <= now:
+                        break
+                    timeout = MAX_SLEEP
+                    if self._timers:
+                        timeout = min(timeout, (self._timers[0][0] - now).total_seconds())
+                    self._condition.wait(timeout)
+                if self._stopped:
+                    return
+                app_names = []
+                while self._timers and self._timers[0][0] <= now:
+                    app_names.append(heapq.heappop(self._timers)[1])
+            self._dispatch_due(app_names)
+
+    def _dispatch_due(self, app_names):
+        session = self.session_factory()
+        try:
+            schedulers = [AppScheduler(app_name, self.sched_conf, session) for app_name in app_names]
+            due = set(s.app_name for s in due_applications(schedulers, session))
+        except Exception as e:
+            self._log.exception('Cannot load scheduler state: %s' % e)
+            # let every application check its state by itself
+            for app_name in app_names:
+                self._queue.put((app_name, NOT_CHECKED))
+            return
+        finally:
+            session.close()
+
+        for scheduler in schedulers:
+            if scheduler.app_name in due:
+                self._log.debug('Dispatching application %s', scheduler.app_name)
+                self._queue.put((scheduler.app_name, scheduler.checked_start))
+            else:
+                self._reschedule(scheduler.app_name, self._next_fire_time(scheduler, False))
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
@@ -1,5 +1,5 @@
 from sqlalchemy import (Column, Integer, BigInteger, SmallInteger,
-                        String, Date, DateTime, Boolean)
+                        String, Date, DateTime, Boolean, Float, Index, UniqueConstraint)
 from sqlalchemy.ext.declarative import declarative_base
 
 
@@ -14,12 +14,40 @@ class SchedulerModel(BaseModel):
     last_started = Column(DateTime)
     last_finished = Column(DateTime)
     last_status = Column(String(255))
+    lease_expires = Column(DateTime)
 
 
 class RunHistoryModel(BaseModel):
     __tablename__ = 'load_history'
+    __table_args__ = (
+        # history of one application
+        Index('ix_load_history_task_start', 'task_id', 'start_time'),
+        # time windows across all applications and retention
+        Index('ix_load_history_start', 'start_time'),
+    )
     id = Column(Integer, primary_key=True)
     start_time = Column(DateTime)
     finish_time = Column(DateTime)
     exec_status = Column(String(255))
-    task_id = Column(Integer)
\ No newline at end of file
+    task_id = Column(Integer)
+    duration = Column(Float)          # secs
+    cpu_time = Column(Float)          # secs of user and system time
+    peak_rss = Column(BigInteger)     # KB
+    rows_processed = Column(BigInteger)
+
+
+class RunHistoryRollupModel(BaseModel):
+    """Aggregated run history of an application per hour or day."""
+    __tablename__ = 'load_history_rollup'
+    __table_args__ = (
+        UniqueConstraint('task_id', 'period', 'period_start'),
+        Index('ix_load_history_rollup_period', 'period', 'period_start'),
+    )
+    id = Column(Integer, primary_key=True)
+    task_id = Column(Integer)
+    period = Column(String(5))        # 'hour' or 'day'
+    period_start = Column(DateTime)
+    runs = Column(Integer, default=0)
+    failures = Column(Integer, default=0)
+    duration_sum = Column(Float, default=0.0)
+    duration_max = Column(Float)
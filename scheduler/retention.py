@@ -0,0 +1,137 @@
+from datetime import datetime, timedelta
+import logging
+
+from models import RunHistoryModel, RunHistoryRollupModel
+
+
+# days raw run history is kept for
+DEFAULT_KEEP_RAW_DAYS = 7
+# days hourly aggregates are kept for before they are rolled up into daily ones
+DEFAULT_KEEP_HOURLY_DAYS = 90
+# rows rolled up and deleted in one transaction
+DEFAULT_BATCH_SIZE = 5000
+# ids in one DELETE statement (SQLite allows 999 bound parameters)
+DELETE_CHUNK_SIZE = 500
+
+PERIODS = {
+    'hour': lambda value: value.replace(minute=0, second=0, microsecond=0),
+    'day': lambda value: value.replace(hour=0, minute=0, second=0, microsecond=0),
+}
+
+
+def _merge_rollups(session, period, aggregates):
+    """
+    Adds aggregates {(task_id, period_start): [runs, failures, duration_sum,
+    duration_max]} to stored rollups of given period.
+    """
+    starts = [period_start for _, period_start in aggregates]
+    existing = session.query(RunHistoryRollupModel).filter(
+                    RunHistoryRollupModel.period == period,
+                    RunHistoryRollupModel.period_start >= min(starts),
+                    RunHistoryRollupModel.period_start <= max(starts))
+    rollups = dict(((rollup.task_id, rollup.period_start), rollup) for rollup in existing)
+    new_rollups = []
+    for (task_id, period_start), (runs, failures, duration_sum, duration_max) in aggregates.iteritems():
+        rollup = rollups.get((task_id, period_start))
+        if rollup is None:
+            new_rollups.append({'task_id': task_id,
+                                'period': period,
+                                'period_start': period_start,
+                                'runs': runs,
+                                'failures': failures,
+                                'duration_sum': duration_sum,
+                                'duration_max': duration_max})
+        else:
+            rollup.runs += runs
+            rollup.failures += failures
+            rollup.duration_sum += duration_sum
+            rollup.duration_max = max(rollup.duration_max, duration_max)
+    if new_rollups:
+        # one executemany instead of an INSERT per ORM object
+        session.execute(RunHistoryRollupModel.__table__.insert(), new_rollups)
+
+
+def _roll_up(session, fetch, model, period, batch_size):
+    """
+    Rolls rows returned by "fetch(limit)" up into aggregates of given period
+    and deletes them from "model" table, "batch_size" rows per transaction.
+    Rows are (id, task_id, time, runs, failures, duration_sum, duration_max)
+    tuples ordered by time.
+    """
+    truncate = PERIODS[period]
+    total = 0
+    while True:
+        rows = fetch(batch_size)
+        if not rows:
+            return total
+        aggregates = {}
+        for _, task_id, time, runs, failures, duration_sum, duration_max in rows:
+            aggregate = aggregates.setdefault((task_id, truncate(time)), [0, 0, 0.0, None])
+            aggregate[0] += runs
+            aggregate[1] += failures
+            aggregate[2] += duration_sum or 0.0
+            aggregate[3] = max(aggregate[3], duration_max)
+        _merge_rollups(session, period, aggregates)
+
+        ids = [row[0] for row in rows]
+        for i in xrange(0, len(ids), DELETE_CHUNK_SIZE):
+            session.query(model).filter(model.id.in_(ids[i:i + DELETE_CHUNK_SIZE])).\
+                delete(synchronize_session=False)
+        session.commit()
+        total += len(rows)
+
+
+def _raw_history(session, before):
+    """Returns function fetching raw history batches in the row shape of _roll_up()."""
+    query = session.query(RunHistoryModel.id,
+                          RunHistoryModel.task_id,
+                          RunHistoryModel.start_time,
+                          RunHistoryModel.finish_time,
+                          RunHistoryModel.exec_status,
+                          RunHistoryModel.duration).\
+        filter(RunHistoryModel.start_time < before).\
+        order_by(RunHistoryModel.start_time, RunHistoryModel.id)
+
+    def fetch(limit):
+        rows = []
+        for row_id, task_id, start_time, finish_time, status, duration in query.limit(limit):
+            if duration is None and finish_time:
+                # rows recorded before durations were stored
+                duration = (finish_time - start_time).total_seconds()
+            rows.append((row_id, task_id, start_time, 1, 1 if status else 0, duration, duration))
+        return rows
+    return fetch
+
+
+def compact_history(session, now=None, keep_raw_days=DEFAULT_KEEP_RAW_DAYS,
+                    keep_hourly_days=DEFAULT_KEEP_HOURLY_DAYS, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Rolls run history older than "keep_raw_days" up into per application
+    hourly aggregates (runs, failures, total and max duration) and hourly
+    aggregates older than "keep_hourly_days" up into daily ones. Rolled up
+    rows are deleted in batches of "batch_size" rows, each batch in its own
+    transaction, so the job can be interrupted at any time.
+
+    Returns numbers of rolled up raw rows and hourly aggregates.
+    """
+    log = logging.getLogger('scheduler')
+    now = now or datetime.now()
+
+    raw_rows = _roll_up(session, _raw_history(session, now - timedelta(days=keep_raw_days)),
+                        RunHistoryModel, 'hour', batch_size)
+    log.info('Rolled up %d run history rows into hourly aggregates', raw_rows)
+
+    hourly = session.query(RunHistoryRollupModel.id,
+                           RunHistoryRollupModel.task_id,
+                           RunHistoryRollupModel.period_start,
+                           RunHistoryRollupModel.runs,
+                           RunHistoryRollupModel.failures,
+                           RunHistoryRollupModel.duration_sum,
+                           RunHistoryRollupModel.duration_max).\
+        filter(RunHistoryRollupModel.period == 'hour',
+               RunHistoryRollupModel.period_start < PERIODS['day'](now - timedelta(days=keep_hourly_days))).\
+        order_by(RunHistoryRollupModel.period_start, RunHistoryRollupModel.id)
+    hourly_rows = _roll_up(session, lambda limit: hourly.limit(limit).all(),
+                           RunHistoryRollupModel, 'day', batch_size)
+    log.info('Rolled up %d hourly aggregates into daily ones', hourly_rows)
+    return raw_rows, hourly_rows
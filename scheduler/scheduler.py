@@ -1,14 +1,208 @@
-from datetime import datetime
+from datetime import datetime, timedelta
 import importlib
+import json
 import logging
+import os
+import resource
 import socket
-import time
+import subprocess
+import sys
+import threading
 
+from sqlalchemy import and_, or_
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
 
 from scheduler_config import *
+from cron import CronSchedule
 from models import SchedulerModel, RunHistoryModel
-from utils import get_datetime_struct
+from sharding import app_jitter
+
+
+# secs application lock is held for without heartbeat
+DEFAULT_LOCK_LEASE = 120
+
+# how application is run: in scheduler thread, in separate thread or in separate process
+EXEC_MODES = ('inline', 'thread', 'process')
+
+# what happens to fire times missed while scheduler was down or application was locked:
+# skipped, run once or run once per missed fire time (up to "misfire_limit" runs)
+MISFIRE_POLICIES = ('skip', 'once', 'all')
+DEFAULT_MISFIRE_LIMIT = 10
+
+# last start of application was not read by is_due() (see AppScheduler.lock())
+NOT_CHECKED = object()
+
+
+# resource usage of the calling thread only (Linux, missing in resource module of Python 2)
+RUSAGE_THREAD = getattr(resource, 'RUSAGE_THREAD', 1 if sys.platform.startswith('linux') else None)
+
+
+class ApplicationError(Exception):
+    pass
+
+
+def _app_module_name(app_name):
+    return '.'.join(['scheduler', 'applications', app_name])
+
+
+def _cpu_time(who):
+    if who is None:
+        return None
+    usage = resource.getrusage(who)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _measured_run(app_name, in_process=False):
+    """
+    Runs application and returns its metrics: CPU time (of the running
+    thread unless "in_process", not measured where per-thread usage is not
+    available), peak RSS of the process (RSS is a high-water mark of the
+    whole process, it is exact only in process mode) and number of rows
+    processed if application run() returns it.
+    """
+    who = resource.RUSAGE_SELF if in_process else RUSAGE_THREAD
+    before = _cpu_time(who)
+    result = importlib.import_module(_app_module_name(app_name)).run()
+    after = _cpu_time(who)
+    return {'cpu_time': after - before if who is not None else None,
+            'peak_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            'rows_processed': result if isinstance(result, (int, long)) and not isinstance(result, bool) else None}
+
+
+# command of application process: imports this module and runs _process_main()
+_PROCESS_COMMAND = 'import importlib, sys; importlib.import_module(sys.argv[1])._process_main(sys.argv[2])'
+
+
+def _set_limits(max_memory=None, max_cpu_time=None):
+    """
+    Applies resource limits ("max_memory" in MB, "max_cpu_time" in secs) of
+    application process, called in the child between fork and exec.
+    """
+    if max_memory:
+        limit = int(max_memory) * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    if max_cpu_time:
+        resource.setrlimit(resource.RLIMIT_CPU, (int(max_cpu_time), int(max_cpu_time)))
+
+
+def _process_main(app_name):
+    """
+    Entry point of application process. Runs application and writes its
+    error (or None) and metrics as JSON to stdout, output of application
+    itself goes to stderr.
+    """
+    result_file = os.fdopen(os.dup(sys.stdout.fileno()), 'w')
+    sys.stdout.flush()
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    logging.basicConfig()
+    error = None
+    metrics = None
+    try:
+        metrics = _measured_run(app_name, in_process=True)
+    except Exception as e:
+        logging.getLogger('scheduler').exception('Runtime error in application %s: %s' % (app_name, e))
+        error = (str(e) or e.__class__.__name__)[:255]
+    json.dump([error, metrics], result_file)
+    result_file.close()
+    logging.shutdown()
+    # like exit of forked process, threads left by application are not waited for
+    os._exit(1 if error else 0)
+
+
+def expire_loads(session, now=None):
+    """
+    Unlocks applications whose lock lease is expired (i.e. there was no
+    heartbeat for the whole lease) with single UPDATE statement. Locks
+    without lease expire APP_EXPIRE_TIMEOUT secs after start.
+    Returns number of unlocked applications.
+    """
+    now = now or datetime.now()
+    expired = session.query(SchedulerModel).filter(
+                    SchedulerModel.lock.isnot(None),
+                    or_(SchedulerModel.lease_expires < now,
+                        and_(SchedulerModel.lease_expires.is_(None),
+                             SchedulerModel.last_started < now - timedelta(seconds=APP_EXPIRE_TIMEOUT)))
+                ).update({SchedulerModel.lock: None,
+                          SchedulerModel.lease_expires: None}, synchronize_session=False)
+    session.commit()
+    if expired:
+        logging.getLogger('scheduler').info('Expired locks of %d applications', expired)
+    return expired
+
+
+class LockHeartbeat(threading.Thread):
+    """
+    Renews lease of application lock from background thread (using its own
+    session) every third of the lease while application is running.
+    """
+
+    def __init__(self, scheduler):
+        super(LockHeartbeat, self).__init__(name='heartbeat-%s' % scheduler.app_name)
+        self.daemon = True
+        self.scheduler = scheduler
+        self.interval = scheduler.lock_lease / 3.0
+        self._stopped = threading.Event()
+
+    def beat(self, session):
+        scheduler = self.scheduler
+        now = datetime.now()
+        renewed = session.query(SchedulerModel).filter(
+                        SchedulerModel.name == scheduler.app_name,
+                        SchedulerModel.lock == scheduler.lock_owner
+                    ).update({SchedulerModel.lease_expires: now + timedelta(seconds=scheduler.lock_lease)},
+                             synchronize_session=False)
+        session.commit()
+        if not renewed:
+            scheduler._log.error("Lock of application '%s' is lost", scheduler.app_name)
+        return bool(renewed)
+
+    def run(self):
+        session = Session(bind=self.scheduler.session.get_bind())
+        try:
+            while not self._stopped.wait(self.interval):
+                try:
+                    if not self.beat(session):
+                        return
+                except Exception as e:
+                    session.rollback()
+                    self.scheduler._log.exception('Cannot renew lock of application %s: %s' %
+                                                  (self.scheduler.app_name, e))
+        finally:
+            session.close()
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+
+def due_applications(schedulers, session, now=None):
+    """
+    Returns schedulers of applications that should start now. State of all
+    applications is loaded with one query and evaluated in memory.
+    """
+    now = now or datetime.now()
+    expire_loads(session, now)
+    apps = dict((app.name, app) for app in session.query(SchedulerModel))
+
+    missing = []
+    for s in schedulers:
+        if s.app_name not in apps:
+            # new application, it was never started
+            s.checked_start = None
+            missing.append(s.app_name)
+    if missing:
+        try:
+            session.add_all([SchedulerModel(name=app_name) for app_name in missing])
+            session.commit()
+        except IntegrityError:
+            # applications were added by a parallel process
+            session.rollback()
+    else:
+        session.commit()
+
+    return [s for s in schedulers
+            if s.app_name not in apps or s.is_due(apps[s.app_name], now)]
 
 
 class AppScheduler(object):
@@ -38,73 +232,36 @@ class AppScheduler(object):
                     self.hours, self.minutes, self.frequency]):
             raise Exception('Scheduling configuration for "%s"" is empty. Please set "frequency" or any timing value',
                             self.app_name)
+        self.schedule = CronSchedule.from_config(app_conf)
         self.retry_limit = app_conf.get('retry_limit', 3)
         self.retry_delay = app_conf.get('retry_delay', 60)
+        # secs the lock is held for if it is not renewed by heartbeat
+        self.lock_lease = app_conf.get('lock_lease', DEFAULT_LOCK_LEASE)
+        self.lock_owner = ("RUNNING on '%s' (%d)" % (socket.gethostname(), os.getpid()))[:50]
+        self.exec_mode = app_conf.get('exec_mode', 'inline')
+        if self.exec_mode not in EXEC_MODES:
+            raise Exception('Unknown execution mode of application "%s": %s' % (self.app_name, self.exec_mode))
+        # wall-clock limit of application run (secs), not applied to inline mode
+        self.timeout = app_conf.get('timeout', None)
+        # resource limits of application process (MB and secs)
+        self.max_memory = app_conf.get('max_memory', None)
+        self.max_cpu_time = app_conf.get('max_cpu_time', None)
+        self.misfire = app_conf.get('misfire', 'skip')
+        if self.misfire not in MISFIRE_POLICIES:
+            raise Exception('Unknown misfire policy of application "%s": %s' % (self.app_name, self.misfire))
+        self.misfire_limit = app_conf.get('misfire_limit', DEFAULT_MISFIRE_LIMIT)
+        max_jitter = app_conf.get('jitter', 0)
+        if not self.frequency and self.misfire == 'skip':
+            # start must stay within the matching minute
+            max_jitter = min(max_jitter, 59)
+        # secs application start is delayed by, the same for the app on every host
+        self.jitter = app_jitter(self.app_name, max_jitter)
         self.session = session
+        # start time application had when is_due() found it due, lock() fails if it changes
+        self.checked_start = NOT_CHECKED
         self.__last_started = None
-
-    def __check_timestamp(self, timestamp):
-        def __match_field(field, value):
-            result = None
-            if field == '*':
-                result = field
-            elif isinstance(field, list):
-                for item in field:
-                    if item == value:
-                        result = value
-                        break
-            else:
-                if field == value:
-                    result = value
-            return result
-
-        year, month, mweek, mday, last_mweek, last_mday, wday, hour, min = \
-                                            get_datetime_struct(timestamp)
-        __month_week = self.month_week
-        if __month_week != '*':
-            if __month_week > last_mweek:
-                __month_week = last_mweek
-
-        __month_days = self.days
-        if __month_days != '*':
-            __new_mdays = []
-            for d in __month_days:
-                if last_mday > d:
-                    d = last_mday
-                __new_mdays.append(d)
-            __month_days = __new_mdays
-
-        matches = [__match_field(arg, value) for arg, value in (
-                        [(self.months, month),
-                         (__month_week, mweek),
-                         (__month_days, mday),
-                         (self.week_days, wday),
-                         (self.hours, hour),
-                         (self.minutes, min)])]
-        result = None
-        checksum_parts = []
-        val_found = False
-        for val, default in zip(matches, [month, mweek, mday, wday, hour, min]):
-            if val == '*' and not val_found:
-                checksum_parts.append(default)
-            else:
-                checksum_parts.append(val)
-                val_found = True
-        if not any([1 for i in checksum_parts if i is None]):
-            return ''.join([str(p) for p in checksum_parts])
-
-    def __expire_loads(self):
-        app_objs = self.session.query(SchedulerModel).filter(
-                        SchedulerModel.lock.isnot(None),
-                        SchedulerModel.last_started < datetime.now() - timedelta(seconds=APP_EXPIRE_TIMEOUT))
-        if app_objs.count() > 0:
-            self._log.info('Found %d locked out application that already need to'
-                           'be expired (%d secs since start)',
-                           app_objs.count(),
-                           APP_EXPIRE_TIMEOUT)
-            for app in app_objs.all():
-                app.lock = None
-            self.session.commit()
+        self.__timed_out_thread = None
+        self.__previous_start = None
 
     def _add_to_scheduler(self):
         """Add application to the scheduler."""
@@ -118,57 +275,99 @@ class AppScheduler(object):
             # rollback transaction
             self.session.rollback()
 
+    def is_due(self, app, now=None):
+        """Checks if application with given scheduler state should start now."""
+        now = now or datetime.now()
+        self.checked_start = app.last_started
+        if app.lock and not (app.lease_expires and app.lease_expires < now):
+            return False
+        if not app.last_started:
+            return True
+        elapsed = (now - app.last_started).total_seconds()
+        if self.frequency:
+            return elapsed > int(self.frequency)
+        if app.last_status and (self.retry_limit == 0 or app.retry_cnt < self.retry_limit) and \
+                elapsed >= self.retry_delay:
+            return True
+        if self.misfire != 'skip':
+            # due if any fire time passed since the last start, not only the current one
+            fire_time = self.schedule.next_fire_time(app.last_started)
+            return bool(fire_time) and fire_time <= now
+        current_slot = self.schedule.match_datetime(now)
+        return bool(current_slot) and current_slot != self.schedule.match_datetime(app.last_started)
+
+    def missed_runs(self, last_started, now=None):
+        """
+        Returns how many times application should run now according to its
+        misfire policy: once per fire time of its schedule passed since
+        "last_started" (up to "misfire_limit") for 'all' policy, otherwise 1.
+        """
+        if self.misfire != 'all' or self.frequency or not last_started:
+            return 1
+        now = now or datetime.now()
+        runs = 0
+        for _ in self.schedule.fire_times(last_started, now):
+            runs += 1
+            if runs >= self.misfire_limit:
+                break
+        return max(runs, 1)
+
     def should_start(self):
-        self.__expire_loads()
+        expire_loads(self.session)
 
-        app_objs = self.session.query(SchedulerModel).filter_by(name=self.app_name)
-        current_timestamp = time.time()
-        result = False
-        if app_objs.count() > 0:
-            app = app_objs.one()
-            if app.lock:
-                result = False
-            elif not app.last_started:
-                result = True
-            elif self.frequency:
-                result = bool((datetime.today() - app.last_started).seconds >
-                              int(self.frequency))
-            elif app.last_status and (self.retry_limit == 0 or app.retry_cnt < self.retry_limit) and \
-                (datetime.today() - app.last_started).seconds >= self.retry_delay:
-                result = True
-            else:
-                current_time_checksum = self.__check_timestamp(current_timestamp)
-                last_started = time.mktime(app.last_started.timetuple())
-                result = ( current_time_checksum and
-                             ( not last_started or
-                               current_time_checksum != self.__check_timestamp(last_started)))
-        else:
+        app = self.session.query(SchedulerModel).filter_by(name=self.app_name).first()
+        if app is None:
             self._add_to_scheduler()
-            result = True
-        return result
-
-    def lock(self):
-        locked = False
-        current_status = "RUNNING on '%s'" % socket.gethostname()
-        query = self.session.query(SchedulerModel).filter_by(name=self.app_name)
-        app_obj = query.with_lockmode('update').one()
-        if not app_obj.lock:
-            self._log.info("Locking application '%s'", self.app_name)
-            app_obj.lock = current_status
-            self.__last_started = datetime.now()
-            app_obj.last_started = self.__last_started
-            locked = True
+            self.checked_start = None
+            return True
+        return self.is_due(app)
+
+    def lock(self, last_started=NOT_CHECKED):
+        """
+        Locks application with one conditional UPDATE (compare-and-set), so it
+        succeeds only if application is not locked or lease of its lock is
+        expired and its start time is still "last_started" seen when it was
+        found due (otherwise another process ran it meanwhile). Without it the
+        current start time is read (forced start). Start time it replaces is
+        kept for missed_runs().
+        """
+        now = datetime.now()
+        if last_started is NOT_CHECKED:
+            previous = self.session.query(SchedulerModel.last_started).filter_by(name=self.app_name).first()
+            previous = previous[0] if previous else None
         else:
-            self.__last_started = app_obj.last_started
-            self._log.warning("Application '%s' is already locked in parallel process", self.app_name)
+            previous = last_started
+        locked = self.session.query(SchedulerModel).filter(
+                        SchedulerModel.name == self.app_name,
+                        or_(SchedulerModel.lock.is_(None),
+                            SchedulerModel.lease_expires < now),
+                        # application was not run by a parallel process since it was read
+                        SchedulerModel.last_started.is_(None) if previous is None
+                        else SchedulerModel.last_started == previous
+                    ).update({SchedulerModel.lock: self.lock_owner,
+                              SchedulerModel.last_started: now,
+                              SchedulerModel.lease_expires: now + timedelta(seconds=self.lock_lease)},
+                             synchronize_session=False)
         self.session.commit()
-        return locked
+        if locked:
+            self._log.info("Locked application '%s'", self.app_name)
+            self.__last_started = now
+            self.__previous_start = previous
+        else:
+            self._log.warning("Application '%s' is already locked in parallel process", self.app_name)
+        return bool(locked)
 
-    def unlock(self, error):
+    def unlock(self, error, metrics=None, release=True):
+        """
+        Unlocks application and records its run to history with its duration
+        and optional metrics returned by run(). With "release=False" the run
+        is recorded but the lock is kept (see _release_after()).
+        """
         if not self.__last_started:
             return
         error = error.strip()
         finish_time = datetime.now()
+        self.__previous_start = None
         self._log.info("Unlocking application '%s'", self.app_name)
         app_objs = self.session.query(SchedulerModel).filter_by(
                                                 name=self.app_name)
@@ -188,21 +387,185 @@ class AppScheduler(object):
             else:
                 app.retry_cnt += 1
                 app.last_status = error
-            app.lock = None
+            if app.lock == self.lock_owner:
+                if release:
+                    app.lock = None
+                    app.lease_expires = None
+            else:
+                self._log.warning("Lock of application '%s' was taken over by: %s",
+                                  self.app_name, app.lock)
 
+        self._add_history(app.id, finish_time, error, metrics)
+        self.session.commit()
+        self.__last_started = None
+
+    def _add_history(self, task_id, finish_time, error, metrics):
+        duration = (finish_time - self.__last_started).total_seconds()
         self._log.info("Logging application '%s' run to history. Exec time is %.2f secs" %
-                       (self.app_name,
-                        float((finish_time - self.__last_started).microseconds)/10**6))
-        history = RunHistoryModel(task_id=app.id,
+                       (self.app_name, duration))
+        metrics = metrics or {}
+        history = RunHistoryModel(task_id=task_id,
                               start_time=self.__last_started,
                               finish_time=finish_time,
-                              exec_status=error)
+                              exec_status=error,
+                              duration=duration,
+                              cpu_time=metrics.get('cpu_time'),
+                              peak_rss=metrics.get('peak_rss'),
+                              rows_processed=metrics.get('rows_processed'))
         self.session.add(history)
+
+    def _release_after(self, thread, heartbeat):
+        """
+        Waits for timed out application thread and releases its lock, which
+        is renewed by heartbeat until then (uses its own session).
+        """
+        thread.join()
+        heartbeat.stop()
+        session = Session(bind=self.session.get_bind())
+        try:
+            session.query(SchedulerModel).filter(
+                    SchedulerModel.name == self.app_name,
+                    SchedulerModel.lock == self.lock_owner
+                ).update({SchedulerModel.lock: None,
+                          SchedulerModel.lease_expires: None}, synchronize_session=False)
+            session.commit()
+            self._log.info("Released lock of timed out application '%s'", self.app_name)
+        except Exception as e:
+            session.rollback()
+            self._log.exception('Cannot release lock of application %s: %s' % (self.app_name, e))
+        finally:
+            session.close()
+
+    def _record_run(self, metrics):
+        """Records successful run of the backlog to history while application stays locked."""
+        finish_time = datetime.now()
+        app = self.session.query(SchedulerModel).filter_by(name=self.app_name).one()
+        self._add_history(app.id, finish_time, '', metrics)
         self.session.commit()
-        self.__last_started = None
+        self.__last_started = finish_time
+
+    def start(self, force=False, last_started=NOT_CHECKED):
+        """
+        Locks, runs and unlocks application if it should start now (or if
+        forced). Forced start of application found due by due_applications()
+        passes its "checked_start" as "last_started", see lock().
+        Application runs more times in a row if its misfire policy asks to
+        run missed fire times, every run is recorded to history.
+        Returns True if application was run by this process.
+        """
+        if not force:
+            if not self.should_start():
+                return False
+            last_started = self.checked_start
+        self._log.info('Ready to start application: %s', self.app_name)
+        if not self.lock(last_started):
+            return False
+        error = ''
+        metrics = None
+        heartbeat = LockHeartbeat(self)
+        heartbeat.start()
+        try:
+            try:
+                runs = self.missed_runs(self.__previous_start)
+                if runs > 1:
+                    self._log.info('Running application %s %d times for missed fire times', self.app_name, runs)
+                for n in xrange(runs):
+                    if n:
+                        self._record_run(metrics)
+                    metrics = self.run()
+            except Exception as e:
+                error = str(e)
+                raise
+        finally:
+            thread, self.__timed_out_thread = self.__timed_out_thread, None
+            if thread is not None and thread.is_alive():
+                # application thread cannot be stopped, it keeps the lock
+                # until it finishes so the application is not started twice
+                self.unlock(error, metrics, release=False)
+                releaser = threading.Thread(target=self._release_after, args=(thread, heartbeat),
+                                            name='release-%s' % self.app_name)
+                releaser.daemon = True
+                releaser.start()
+            else:
+                heartbeat.stop()
+                self.unlock(error, metrics)
+        return True
 
     def run(self):
-        module_name = '.'.join(['scheduler', 'applications', self.app_name])
-        app_module = importlib.import_module(module_name)
-        self._log.info('Running application %s', self.app_name)
-        app_module.run()
+        """
+        Runs application according to its "exec_mode" and returns its
+        metrics. Failure, timeout or non-zero exit status of application
+        process raise an exception, so start() records it as the run error.
+        """
+        self._log.info('Running application %s (%s)', self.app_name, self.exec_mode)
+        if self.exec_mode == 'process':
+            return self._run_process()
+        elif self.exec_mode == 'thread':
+            return self._run_thread()
+        return _measured_run(self.app_name)
+
+    def _run_thread(self):
+        errors = []
+        results = []
+
+        def target():
+            try:
+                results.append(_measured_run(self.app_name))
+            except Exception as e:
+                errors.append(e)
+
+        thread = threading.Thread(target=target, name='app-%s' % self.app_name)
+        # hung application thread cannot be killed, it must not block exit
+        thread.daemon = True
+        thread.start()
+        thread.join(self.timeout)
+        if thread.is_alive():
+            self.__timed_out_thread = thread
+            raise ApplicationError('Application %s timed out after %s secs' % (self.app_name, self.timeout))
+        if errors:
+            raise errors[0]
+        return results[0]
+
+    def _run_process(self):
+        # fresh interpreter rather than fork: forked copy of multi-threaded daemon inherits
+        # locks held by other threads at fork time (e.g. of logging handlers) and can deadlock
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(path or os.getcwd() for path in sys.path)
+        max_memory, max_cpu_time = self.max_memory, self.max_cpu_time
+        process = subprocess.Popen([sys.executable, '-c', _PROCESS_COMMAND, __name__, self.app_name],
+                                   stdout=subprocess.PIPE, close_fds=True, env=env,
+                                   preexec_fn=lambda: _set_limits(max_memory, max_cpu_time))
+        timed_out = []
+
+        def terminate():
+            if process.poll() is None:
+                timed_out.append(True)
+                try:
+                    process.terminate()
+                except OSError:
+                    pass
+
+        timer = None
+        if self.timeout:
+            timer = threading.Timer(self.timeout, terminate)
+            timer.daemon = True
+            timer.start()
+        try:
+            output = process.communicate()[0]
+        finally:
+            if timer:
+                timer.cancel()
+        if timed_out:
+            raise ApplicationError('Application %s timed out after %s secs' % (self.app_name, self.timeout))
+        try:
+            error, metrics = json.loads(output)
+        except ValueError:
+            # process died before reporting its result
+            error, metrics = None, None
+        if error:
+            raise ApplicationError(error)
+        if process.returncode < 0:
+            raise ApplicationError('Application %s killed by signal %d' % (self.app_name, -process.returncode))
+        if process.returncode:
+            raise ApplicationError('Application %s exited with status %d' % (self.app_name, process.returncode))
+        return metrics
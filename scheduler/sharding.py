@@ -0,0 +1,43 @@
+from bisect import bisect
+import hashlib
+
+
+# points of every host on the hash ring
+DEFAULT_REPLICAS = 100
+
+
+def stable_hash(value):
+    """Hash of a string which is the same in every process and on every host."""
+    return int(hashlib.md5(value.encode('utf-8') if isinstance(value, unicode) else value).hexdigest()[:15], 16)
+
+
+def app_jitter(app_name, max_jitter):
+    """Deterministic delay (secs, 0..max_jitter) of application start."""
+    if not max_jitter:
+        return 0
+    return stable_hash('jitter:%s' % app_name) % (int(max_jitter) + 1)
+
+
+class HashRing(object):
+    """
+    Consistent hash ring of named runner hosts. Every application belongs to
+    exactly one host, adding or removing a host moves only applications of
+    its share of the ring.
+    """
+
+    def __init__(self, hosts, replicas=DEFAULT_REPLICAS):
+        if not hosts:
+            raise Exception('Hash ring needs at least one host')
+        self.hosts = sorted(set(hosts))
+        points = sorted((stable_hash('%s#%d' % (host, i)), host)
+                        for host in self.hosts for i in xrange(replicas))
+        self._hashes = [point for point, _ in points]
+        self._hosts = [host for _, host in points]
+
+    def owner(self, app_name):
+        index = bisect(self._hashes, stable_hash(app_name)) % len(self._hashes)
+        return self._hosts[index]
+
+    def shard(self, app_names, host):
+        """Returns applications of given host."""
+        return [app_name for app_name in app_names if self.owner(app_name) == host]
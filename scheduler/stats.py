@@ -0,0 +1,119 @@
+from datetime import datetime, timedelta
+import json
+import time
+
+from models import SchedulerModel, RunHistoryModel
+
+
+PERCENTILES = (50, 95, 99)
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of already sorted values."""
+    if not sorted_values:
+        return None
+    rank = max(int(-(-pct * len(sorted_values) // 100)), 1)
+    return sorted_values[rank - 1]
+
+
+def run_stats(session, since=None, until=None, app_names=None):
+    """
+    Returns run statistics of applications started within the window
+    [since, until) (last 24 hours by default) as a dict keyed by application
+    name: number of runs and failures, failure rate, p50/p95/p99 and total
+    duration (secs), CPU time, max peak RSS (KB) and rows processed.
+    """
+    until = until or datetime.now()
+    since = since or until - timedelta(days=1)
+    query = session.query(SchedulerModel.name,
+                          RunHistoryModel.start_time,
+                          RunHistoryModel.finish_time,
+                          RunHistoryModel.exec_status,
+                          RunHistoryModel.duration,
+                          RunHistoryModel.cpu_time,
+                          RunHistoryModel.peak_rss,
+                          RunHistoryModel.rows_processed).\
+        join(RunHistoryModel, RunHistoryModel.task_id == SchedulerModel.id).\
+        filter(RunHistoryModel.start_time >= since, RunHistoryModel.start_time < until)
+    if app_names:
+        query = query.filter(SchedulerModel.name.in_(list(app_names)))
+
+    runs = {}
+    for name, start_time, finish_time, status, duration, cpu_time, peak_rss, rows in query:
+        if duration is None and start_time and finish_time:
+            # rows recorded before durations were stored
+            duration = (finish_time - start_time).total_seconds()
+        app = runs.setdefault(name, {'durations': [], 'failures': 0, 'cpu_time': 0.0,
+                                     'peak_rss': None, 'rows_processed': 0})
+        if duration is not None:
+            app['durations'].append(duration)
+        if status:
+            app['failures'] += 1
+        app['cpu_time'] += cpu_time or 0.0
+        if peak_rss is not None:
+            app['peak_rss'] = max(app['peak_rss'], peak_rss)
+        app['rows_processed'] += rows or 0
+
+    stats = {}
+    for name, app in runs.iteritems():
+        durations = sorted(app.pop('durations'))
+        count = len(durations)
+        app_stats = {'runs': count,
+                     'failures': app['failures'],
+                     'failure_rate': float(app['failures']) / count if count else 0.0,
+                     'duration_sum': sum(durations)}
+        for pct in PERCENTILES:
+            app_stats['p%d' % pct] = percentile(durations, pct)
+        app_stats.update(app)
+        stats[name] = app_stats
+    return stats
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _sample(value):
+    # database drivers return long (printed as "123L" by %r) or Decimal values
+    return repr(float(value))
+
+
+def export_prometheus(stats, stream):
+    """Writes statistics returned by run_stats() in Prometheus text format."""
+    lines = ['# HELP scheduler_app_duration_seconds Duration of application runs.',
+             '# TYPE scheduler_app_duration_seconds summary']
+    for name in sorted(stats):
+        app = stats[name]
+        for pct in PERCENTILES:
+            if app['p%d' % pct] is not None:
+                lines.append('scheduler_app_duration_seconds{app="%s",quantile="%s"} %s' %
+                             (_label(name), pct / 100.0, _sample(app['p%d' % pct])))
+        lines.append('scheduler_app_duration_seconds_sum{app="%s"} %s' % (_label(name), _sample(app['duration_sum'])))
+        lines.append('scheduler_app_duration_seconds_count{app="%s"} %d' % (_label(name), app['runs']))
+
+    for metric, key, help_text in (
+            ('scheduler_app_failures', 'failures', 'Number of failed application runs.'),
+            ('scheduler_app_failure_ratio', 'failure_rate', 'Share of failed application runs.'),
+            ('scheduler_app_cpu_seconds', 'cpu_time', 'CPU time of application runs.'),
+            ('scheduler_app_peak_rss_kilobytes', 'peak_rss', 'Max peak RSS of application runs.'),
+            ('scheduler_app_rows_processed', 'rows_processed', 'Rows processed by application runs.')):
+        lines.append('# HELP %s %s' % (metric, help_text))
+        lines.append('# TYPE %s gauge' % metric)
+        for name in sorted(stats):
+            if stats[name][key] is not None:
+                lines.append('%s{app="%s"} %s' % (metric, _label(name), _sample(stats[name][key])))
+    stream.write('\n'.join(lines) + '\n')
+
+
+def export_json_lines(stats, stream, timestamp=None):
+    """Writes statistics returned by run_stats() as one JSON object per application."""
+    timestamp = timestamp or time.time()
+    for name in sorted(stats):
+        record = dict(stats[name], app=name, timestamp=timestamp)
+        stream.write(json.dumps(record, sort_keys=True) + '\n')
+
+
+EXPORTERS = {
+    'prometheus': export_prometheus,
+    'json': export_json_lines,
+}
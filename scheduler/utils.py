@@ -1,4 +1,21 @@
-from datetime import datetime, timedelta
+from calendar import monthrange
+from datetime import datetime
+
+
+def month_week(mday, first_wday):
+    """Week number (weeks start on Monday) of given day within its month."""
+    return (mday - 1 + first_wday) // 7
+
+
+def get_date_struct(day):
+    """
+    Returns date part of the structure returned by get_datetime_struct():
+    (year, month, mweek, mday, last_mday, last_mweek, wday)
+    """
+    year, month, mday = day.year, day.month, day.day
+    first_wday, last_mday = monthrange(year, month)
+    return (year, month, month_week(mday, first_wday), mday,
+            last_mday, month_week(last_mday, first_wday), (first_wday + mday - 1) % 7)
 
 
 def get_datetime_struct(timestamp):
@@ -10,16 +27,10 @@ def get_datetime_struct(timestamp):
       * mweek - week number within current month (0-5 usually)
       * mday - day of month
       * last_mday - last day of current month
-      * last_wday - last week of current month
+      * last_mweek - last week of current month
       * wday - calendar day of the week (0 is Monday)
       * hour - current hour
       * min - current minute)
-      * timestamp - time in seconds since epoch
     """
     current_time = datetime.fromtimestamp(timestamp)
-    year, month, mday, hour, min, _, wday, _, _ = current_time.timetuple()
-    mweek = current_time.isocalendar()[1] - datetime(year, month, 1).isocalendar()[1]
-    last_mday = datetime(year, month+1, 1) - timedelta(days=1)
-    last_mweek = last_mday.isocalendar()[1] - datetime(year, month, 1).isocalendar()[1]
-
-    return (year, month, mweek, mday, last_mday.day, last_mweek, wday, hour, min)
\ No newline at end of file
+    return get_date_struct(current_time) + (current_time.hour, current_time.minute)